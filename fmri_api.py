@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This layer is the Python API of the pre-processing pipeline, for callers that do not go through run_fmri.py json
+A Pipeline is built from a PipelineConfig instead of the global template_dict of run_fmri.py, and its run generator yields
+the result of each subject as soon as the subject finishes, so that downstream steps can start while the cohort is still
+processing
+e.g.:
+    config = PipelineConfig(FWHM_SMOOTH=[6, 6, 6], num_workers=4)
+    for result in Pipeline(config, '/output').run(nifti_files, data_type='nifti'):
+        if result.error is None:
+            print(result.sub_id, result.fmri_out, result.FD_rms_mean, result.runtime)
+"""
+import os, copy
+
+import fmri_bids_index
+import fmri_conversion
+import fmri_planner
+import fmri_qc_table
+import fmri_scheduler
+import fmri_subject_layer
+
+
+class PipelineConfig:
+    """Options of a run, the keys of run_fmri.py template_dict with the same defaults
+    Options whose default is a bool, int, float, tuple or list are converted to that type, unknown options raise a
+    TypeError. As in run_fmri.py json, a list of values for an axis of FWHM_SMOOTH or a list of voxel size lists for
+    options_normalize_write_voxel_sizes is swept, sweep_variants is built from them and can not be set
+        e.g.:
+            config = PipelineConfig(num_workers=4)
+            config.num_workers
+            config = PipelineConfig(FWHM_SMOOTH=[[4, 6, 8], [4, 6, 8], [4, 6, 8]])
+    """
+
+    def __init__(self, **options):
+        import run_fmri
+        self.__dict__['options'] = copy.deepcopy(run_fmri.template_dict)
+        self.__dict__['sweep'] = {
+            'FWHM_SMOOTH': [[value] for value in self.options['FWHM_SMOOTH']],
+            'options_normalize_write_voxel_sizes': [self.options['options_normalize_write_voxel_sizes']]
+        }
+        for key, value in options.items():
+            setattr(self, key, value)
+
+    def __getattr__(self, key):
+        try:
+            return self.__dict__['options'][key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def __setattr__(self, key, value):
+        options = self.__dict__['options']
+        if key not in options:
+            raise TypeError('Unknown pipeline option: ' + str(key))
+        if key == 'sweep_variants':
+            raise TypeError('sweep_variants is built from the swept FWHM_SMOOTH and options_normalize_write_voxel_sizes')
+        if key in self.__dict__['sweep']:
+            self.set_swept(key, value)
+            return
+        default = options[key]
+        if value is not None and default is not None:
+            if isinstance(default, bool):
+                import run_fmri
+                value = run_fmri.parse_bool(value)
+            else:
+                for option_type in (int, float, tuple, list):
+                    if isinstance(default, option_type):
+                        value = option_type(value)
+                        break
+        options[key] = value
+
+    def set_swept(self, key, value):
+        """Sets an option that can be swept, the option gets the first value and sweep_variants every combination"""
+        import run_fmri
+        sweep = self.__dict__['sweep']
+        if key == 'FWHM_SMOOTH':
+            sweep[key] = [[float(axis_value) for axis_value in values] if isinstance(values, (list, tuple)) else
+                          [float(values)] for values in value]
+            self.options[key] = [values[0] for values in sweep[key]]
+        else:
+            sweep[key] = [list(values) for values in value] if isinstance(value[0], (list, tuple)) else [list(value)]
+            self.options[key] = sweep[key][0]
+        self.options['sweep_variants'] = run_fmri.sweep_variants(sweep['FWHM_SMOOTH'],
+                                                                 sweep['options_normalize_write_voxel_sizes'])
+
+    def template_dict(self):
+        """Returns a copy of the options as the template_dict passed to the pipeline layers"""
+        return copy.deepcopy(self.__dict__['options'])
+
+
+class SubjectResult:
+    """Result of one subject, yielded by Pipeline.run"""
+
+    __slots__ = ['index', 'input', 'sub_id', 'session', 'fmri_out', 'output_dirs', 'FD_rms_mean', 'runtime',
+                 'peak_memory', 'error']
+
+    def __init__(self, subject_plan, result, data_type, **template_dict):
+        self.index = subject_plan.index
+        self.input = subject_plan.path
+        if 'sub_id' in result:
+            self.sub_id, self.session = result['sub_id'], result['session']
+        else:
+            self.sub_id, self.session = fmri_subject_layer.subject_ids(subject_plan, data_type)
+        self.fmri_out = result.get('fmri_out')
+        self.output_dirs = [os.path.join(self.fmri_out, dirname) for dirname in
+                            fmri_subject_layer.output_dirnames(**template_dict)] if self.fmri_out else list()
+        self.FD_rms_mean = result.get('FD_rms_mean')
+        self.runtime = result.get('runtime')
+        self.peak_memory = result.get('peak_memory')
+        self.error = result.get('error')
+
+
+class Pipeline:
+    """Pre-processing pipeline writing its outputs to write_dir
+        Args:
+            config (PipelineConfig): options of the run
+            write_dir (string): Directory to write outputs, each subject's outputs go to write_dir/sub_id/session/func
+    """
+
+    def __init__(self, config, write_dir):
+        self.config = config
+        self.write_dir = write_dir
+
+    def qc_table(self):
+        """Returns the cohort QC table of the subjects run so far, a numpy record array with a row per subject
+        (fmri_qc_table.RECORD_DTYPE)"""
+        return fmri_qc_table.read_table(self.write_dir, **self.config.template_dict())
+
+    def flagged_subjects(self):
+        """Returns the sub-id and session of the subjects flagged by QA"""
+        return fmri_qc_table.flagged_subjects(self.qc_table())
+
+    def subjects(self, data, data_type):
+        """Returns the input subjects, the valid func scans of a BIDS directory or the nifti files/dicom directories"""
+        if data_type == 'bids':
+            return fmri_bids_index.discover(data, **self.config.template_dict())[0]
+        return list(data)
+
+    def run(self, data, data_type='nifti'):
+        """Runs the pipeline on the input data and yields a SubjectResult per subject as each subject finishes
+        Args:
+            data (list or string): nifti files, dicom directories or a BIDS directory
+            data_type (string): bids, nifti, dicoms
+        Comments:
+            Subjects run concurrently according to num_workers, longest estimated runtime first, a subject's failure is
+            reported in its result instead of stopping the run. Raises EnvironmentError if the outputs do not fit in
+            write_dir. The cohort QC table of an earlier run in write_dir is removed, the subjects flagged by QA are
+            written to qa_flagged_filename once every subject has finished
+        """
+        from nipype.interfaces import spm
+        template_dict = self.config.template_dict()
+        spm.SPMCommand.set_mlab_paths(matlab_cmd=template_dict['matlab_cmd'], use_mcr=True)
+        os.makedirs(self.write_dir, exist_ok=True)
+        fmri_qc_table.reset_table(self.write_dir, **template_dict)
+
+        subject_plans = fmri_planner.plan_subjects(self.subjects(data, data_type), data_type, self.write_dir,
+                                                   **template_dict)
+        # Dicoms are converted ahead of the processing, in a pool of their own
+        conversion_pool = None
+        if data_type == 'dicoms':
+            conversion_pool = fmri_conversion.ConversionPool(subject_plans, self.write_dir, **template_dict)
+
+        try:
+            for subject_plan, result in fmri_scheduler.run_subjects(subject_plans, fmri_subject_layer.process_subject,
+                                                                    (self.write_dir, data_type), conversion_pool,
+                                                                    **template_dict):
+                if not result.get('error'):
+                    fmri_planner.record_timing(subject_plan, result['runtime'], result['peak_memory'],
+                                               **template_dict)
+                yield SubjectResult(subject_plan, result, data_type, **template_dict)
+            fmri_qc_table.write_flagged_file(self.qc_table(), self.write_dir, **template_dict)
+        finally:
+            if conversion_pool is not None:
+                conversion_pool.shutdown()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This layer writes the output zip while the subjects run, instead of zipping the output directory once they are all done
+Outputs are queued as each subject finishes and a writer thread appends them to the archive. Files are deflated in
+blocks by a pool of threads, each block compressed on its own and flushed to a byte boundary so that the blocks
+concatenate into one deflate stream, like pigz. Files that are compressed already (.nii.gz, .png) are stored as they are.
+The archive is written under a temporary name and renamed when it is complete
+"""
+import os, zlib, zipfile, threading, queue, time
+from concurrent.futures import ThreadPoolExecutor
+
+BLOCK_SIZE = 4 * 1024 ** 2  # uncompressed bytes deflated by one thread at a time
+STORED_EXTENSIONS = ('.gz', '.png', '.zip')
+
+
+def deflate_block(data, level, last):
+    """Returns the raw deflate data of a block, ending on a byte boundary unless it is the last block of the file"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class StreamingArchive:
+    """Zip file written in the background as files are added
+        Args:
+            zip_file (string): archive written
+            root_dir (string): directory the names in the archive are relative to
+            template_dict ( dictionary) : Dictionary that stores all the paths, file names, software locations
+        e.g.:
+            archive = StreamingArchive('fmri_outputs.zip', 'fmri_outputs', **template_dict)
+            archive.add_tree('fmri_outputs/sub-01')
+            archive.close()
+    """
+
+    def __init__(self, zip_file, root_dir, **template_dict):
+        self.zip_file = zip_file
+        self.root_dir = root_dir
+        self.level = int(template_dict['archive_compresslevel'])
+        self.num_threads = max(1, int(template_dict['archive_num_threads']) or os.cpu_count() or 1)
+        self.added = set()
+        self.error = None
+        self.closed = False
+        self.queue = queue.Queue()
+        self.zip = zipfile.ZipFile(zip_file + '.tmp', 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+        self.pool = ThreadPoolExecutor(self.num_threads)
+        self.writer = threading.Thread(target=self.write_queued)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def add(self, file_path):
+        """Queues one file, its name in the archive is its path relative to root_dir"""
+        if os.path.abspath(file_path) not in self.added:
+            self.added.add(os.path.abspath(file_path))
+            self.queue.put(file_path)
+
+    def add_tree(self, directory):
+        """Queues every file under directory"""
+        for dirpath, dirnames, filenames in os.walk(directory):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                self.add(os.path.join(dirpath, filename))
+
+    def write_queued(self):
+        while True:
+            file_path = self.queue.get()
+            if file_path is None:
+                break
+            if self.error is None:
+                try:
+                    self.write_file(file_path)
+                except Exception as e:
+                    self.error = e
+
+    def compressed_blocks(self, fp, stored):
+        """Yields (uncompressed block, compressed block) of the file in order, at most two blocks per thread in flight"""
+        pending = list()
+        data = fp.read(BLOCK_SIZE)
+        while True:
+            next_data = fp.read(BLOCK_SIZE) if data else b''
+            if stored:
+                yield data, data
+            else:
+                pending.append((data, self.pool.submit(deflate_block, data, self.level, not next_data)))
+                while pending and (len(pending) >= 2 * self.num_threads or not next_data):
+                    block, future = pending.pop(0)
+                    yield block, future.result()
+            if not next_data:
+                return
+            data = next_data
+
+    def write_file(self, file_path):
+        """Appends one file to the archive, its header is rewritten with the sizes and crc once the data is written
+        The local header and data are written straight to the archive's file and the entry is registered in the
+        ZipFile's private fp, NameToInfo, start_dir and _didModify, so that ZipFile.close writes the central directory.
+        These internals are those of CPython 3.6 to 3.11, check them when moving the image to another Python version
+        """
+        zinfo = zipfile.ZipInfo.from_file(file_path, os.path.relpath(file_path, self.root_dir))
+        stored = file_path.endswith(STORED_EXTENSIONS)
+        zinfo.compress_type = zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED
+        zinfo.file_size = 0
+        zinfo.compress_size = 0
+        zinfo.CRC = 0
+        # Same rule as zipfile for the zip64 extra field, the header keeps its length when it is rewritten
+        zip64 = os.path.getsize(file_path) * 1.05 > zipfile.ZIP64_LIMIT
+
+        archive_fp = self.zip.fp
+        zinfo.header_offset = archive_fp.tell()
+        archive_fp.write(zinfo.FileHeader(zip64))
+        crc = 0
+        with open(file_path, 'rb') as fp:
+            for block, compressed in self.compressed_blocks(fp, stored):
+                crc = zlib.crc32(block, crc)
+                zinfo.file_size += len(block)
+                zinfo.compress_size += len(compressed)
+                archive_fp.write(compressed)
+        zinfo.CRC = crc & 0xffffffff
+        end = archive_fp.tell()
+        archive_fp.seek(zinfo.header_offset)
+        archive_fp.write(zinfo.FileHeader(zip64))
+        archive_fp.seek(end)
+
+        # Registered like zipfile.ZipFile.mkdir registers the entries it writes itself
+        self.zip.filelist.append(zinfo)
+        self.zip.NameToInfo[zinfo.filename] = zinfo
+        self.zip.start_dir = end
+        self.zip._didModify = True
+
+    def close(self):
+        """Adds the files of root_dir not added yet, waits for the writer and renames the complete archive
+            Returns:
+                zip_file (string): the archive
+                wait_time (float): seconds spent waiting for the archive to be written
+        """
+        start_time = time.time()
+        self.add_tree(self.root_dir)
+        self.queue.put(None)
+        self.writer.join()
+        self.pool.shutdown()
+        self.zip.close()
+        self.closed = True
+        if self.error is not None:
+            os.remove(self.zip_file + '.tmp')
+            raise self.error
+        os.replace(self.zip_file + '.tmp', self.zip_file)
+        return self.zip_file, time.time() - start_time
+
+    def abort(self):
+        """Stops the archive and removes it, nothing to do once the archive is closed"""
+        if self.closed:
+            return
+        self.closed = True
+        self.error = self.error or RuntimeError('archive aborted')
+        self.queue.put(None)
+        self.writer.join()
+        self.pool.shutdown()
+        self.zip.close()
+        os.remove(self.zip_file + '.tmp')
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This layer finds the func scans of a BIDS directory without running bids-validator or building a full BIDSLayout
+Only the sub-*/[ses-*/]func directories are walked, in parallel threads, for *.nii.gz scans and their json sidecars.
+Directory listings are persisted in cache_dir keyed on each directory's mtime, so a later run only lists the directories
+that changed. Only the scans that will be processed are validated, and their validation is cached with the file's
+mtime and size
+"""
+import os, re, hashlib, threading, warnings
+from concurrent.futures import ThreadPoolExecutor
+with warnings.catch_warnings():
+    warnings.filterwarnings("ignore")
+import ujson as json
+
+ENTITY_NAMES = {'sub': 'subject', 'ses': 'session', 'task': 'task', 'acq': 'acquisition', 'run': 'run', 'echo': 'echo'}
+FUNC_FILE_PATTERN = re.compile(
+    r'^sub-[a-zA-Z0-9]+(_ses-[a-zA-Z0-9]+)?_task-[a-zA-Z0-9]+(_[a-z]+-[a-zA-Z0-9]+)*_(bold|cbv|phase|sbref)\.nii\.gz$')
+
+
+class BidsFile:
+    """A func scan, with the filename and entities attributes used from the pybids files"""
+
+    __slots__ = ['filename', 'entities', 'sidecar']
+
+    def __init__(self, filename, entities, sidecar=None):
+        self.filename = filename
+        self.entities = entities
+        self.sidecar = sidecar
+
+
+def parse_entities(file_name):
+    """Returns the BIDS entities of a file name, e.g. sub-01_ses-1_task-rest_bold.nii.gz -> subject 01, session 1"""
+    entities = dict()
+    parts = file_name.split('.')[0].split('_')
+    for part in parts[:-1]:
+        if '-' in part:
+            key, value = part.split('-', 1)
+            entities[ENTITY_NAMES.get(key, key)] = value
+    entities['suffix'] = parts[-1]
+    return entities
+
+
+class BidsIndex:
+    """Index of the func scans of a BIDS directory persisted in cache_dir
+        Args:
+            bids_dir (string): BIDS directory
+            template_dict ( dictionary) : Dictionary that stores all the paths, file names, software locations
+    """
+
+    def __init__(self, bids_dir, **template_dict):
+        self.bids_dir = os.path.abspath(bids_dir)
+        self.num_threads = template_dict['bids_index_num_threads']
+        self.index_file = os.path.join(template_dict['cache_dir'], 'bids_index',
+                                       hashlib.sha1(self.bids_dir.encode('utf-8')).hexdigest() + '.json')
+        self.lock = threading.Lock()
+        try:
+            with open(self.index_file) as fp:
+                index = json.loads(fp.read())
+        except (IOError, OSError, ValueError):
+            index = dict()
+        self.listings = index.get('listings', dict())
+        self.validation = index.get('validation', dict())
+
+    def listdir(self, path):
+        """Returns the [name, is_dir] entries of a directory, listed again only when its mtime changed"""
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return list()
+        listing = self.listings.get(path)
+        if listing is None or listing['mtime'] != mtime:
+            entries = sorted([[entry.name, entry.is_dir()] for entry in os.scandir(path)])
+            listing = {'mtime': mtime, 'entries': entries}
+            with self.lock:
+                self.listings[path] = listing
+        return listing['entries']
+
+    def subject_func_dirs(self, sub_dir):
+        """Returns the func directories of a subject, with or without sessions"""
+        func_dirs = list()
+        for name, is_dir in self.listdir(sub_dir):
+            if is_dir and name == 'func':
+                func_dirs.append(os.path.join(sub_dir, name))
+            elif is_dir and name.startswith('ses-'):
+                func_dirs.extend([os.path.join(sub_dir, name, 'func') for session_name, session_is_dir in
+                                  self.listdir(os.path.join(sub_dir, name)) if session_is_dir and session_name == 'func'])
+        return func_dirs
+
+    def sidecar(self, func_dir, file_name):
+        """Returns the json sidecar of a scan, next to the scan or inherited from the session, subject or top directory"""
+        entities = parse_entities(file_name)
+        stem = file_name.split('.')[0]
+        directories = [func_dir, os.path.dirname(func_dir)]
+        if os.path.basename(os.path.dirname(func_dir)).startswith('ses-'):
+            directories.append(os.path.dirname(os.path.dirname(func_dir)))
+        directories.append(self.bids_dir)
+        for directory in directories:
+            for name, is_dir in self.listdir(directory):
+                if is_dir or not name.endswith('.json'):
+                    continue
+                if name.split('.')[0] == stem:
+                    return os.path.join(directory, name)
+                sidecar_entities = parse_entities(name)
+                if sidecar_entities['suffix'] == entities['suffix'] and all(
+                        [entities.get(key) == value for key, value in sidecar_entities.items()]):
+                    return os.path.join(directory, name)
+        return None
+
+    def func_files(self, func_dir):
+        files = list()
+        for name, is_dir in self.listdir(func_dir):
+            if not is_dir and name.endswith('.nii.gz'):
+                files.append(BidsFile(os.path.join(func_dir, name), parse_entities(name), self.sidecar(func_dir, name)))
+        return files
+
+    def scans(self):
+        """Returns the func *.nii.gz scans of the BIDS directory, in subject and session order"""
+        sub_dirs = [os.path.join(self.bids_dir, name) for name, is_dir in self.listdir(self.bids_dir) if
+                    is_dir and name.startswith('sub-')]
+        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+            func_dirs = [func_dir for sub_func_dirs in executor.map(self.subject_func_dirs, sub_dirs) for func_dir in
+                         sub_func_dirs]
+            return [bids_file for files in executor.map(self.func_files, func_dirs) for bids_file in files]
+
+    def check_scan(self, bids_file):
+        """Returns the validation error of a scan, None if it is valid"""
+        file_name = os.path.basename(bids_file.filename)
+        if not FUNC_FILE_PATTERN.match(file_name):
+            return 'File name does not follow the BIDS func naming'
+        directories = bids_file.filename[len(self.bids_dir) + 1:].split(os.sep)[:-2]
+        if directories[0] != 'sub-' + bids_file.entities['subject'] or (
+                len(directories) > 1) != ('session' in bids_file.entities) or (
+                len(directories) > 1 and directories[1] != 'ses-' + bids_file.entities['session']):
+            return 'Subject or session of the file name does not match its directory'
+        if bids_file.entities['suffix'] == 'bold':
+            if bids_file.sidecar is None:
+                return 'No json sidecar found'
+            try:
+                with open(bids_file.sidecar) as fp:
+                    if 'RepetitionTime' not in json.loads(fp.read()):
+                        return 'RepetitionTime missing from ' + bids_file.sidecar
+            except (IOError, OSError, ValueError) as e:
+                return 'Unreadable json sidecar ' + bids_file.sidecar + ': ' + str(e)
+        try:
+            import nibabel as nib
+            header = nib.load(bids_file.filename).header
+            if len(header.get_data_shape()) != 4:
+                return 'Not a 4D image'
+        except Exception as e:
+            return 'Unreadable nifti file: ' + str(e)
+        return None
+
+    def validate(self, bids_file):
+        """Returns the cached validation error of a scan, checks it again when the scan or its sidecar changed"""
+        try:
+            stat = os.stat(bids_file.filename)
+            key = [stat.st_mtime, stat.st_size, bids_file.sidecar,
+                   os.stat(bids_file.sidecar).st_mtime if bids_file.sidecar else None]
+        except OSError as e:
+            return str(e)
+        cached = self.validation.get(bids_file.filename)
+        if cached is not None and cached['key'] == key:
+            return cached['error']
+        error = self.check_scan(bids_file)
+        with self.lock:
+            self.validation[bids_file.filename] = {'key': key, 'error': error}
+        return error
+
+    def save(self):
+        """Persists the index, written to a temporary file first so that concurrent runs never read half of it"""
+        try:
+            os.makedirs(os.path.dirname(self.index_file), exist_ok=True)
+            tmp_file = self.index_file + '.' + str(os.getpid())
+            with open(tmp_file, 'w') as fp:
+                fp.write(json.dumps({'listings': self.listings, 'validation': self.validation}))
+            os.replace(tmp_file, self.index_file)
+        except (IOError, OSError):
+            pass
+
+
+def discover(bids_dir, **template_dict):
+    """Returns the valid func scans of a BIDS directory and the validation errors of the others
+        Args:
+            bids_dir (string): BIDS directory
+            template_dict ( dictionary) : Dictionary that stores all the paths, file names, software locations
+        Returns:
+            scans (list): BidsFile of each valid func scan
+            errors (dict): validation error of each invalid scan or of the directory
+    """
+    if not os.path.isfile(os.path.join(bids_dir, 'dataset_description.json')):
+        return list(), {bids_dir: 'dataset_description.json missing'}
+    bids_index = BidsIndex(bids_dir, **template_dict)
+    scans = bids_index.scans()
+    with ThreadPoolExecutor(max_workers=bids_index.num_threads) as executor:
+        scan_errors = list(executor.map(bids_index.validate, scans))
+    bids_index.save()
+    errors = dict([(bids_file.filename, error) for bids_file, error in zip(scans, scan_errors) if error])
+    return [bids_file for bids_file, error in zip(scans, scan_errors) if not error], errors
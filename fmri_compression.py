@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This layer compresses the nifti outputs to .nii.gz in parallel, when output_compression is set
+A file is cut into blocks that a pool of threads compresses, each block as a gzip member of its own, and the members are
+written in order. A file of concatenated gzip members is a valid gzip file for gzip, nibabel, SPM and AFNI. The member
+offsets are written as the file's seek-point index (fmri_gzip_index), so single volumes of the outputs can be read
+without decompressing from the start
+"""
+import os, glob, gzip, time, warnings
+from concurrent.futures import ThreadPoolExecutor
+with warnings.catch_warnings():
+    warnings.filterwarnings("ignore")
+import ujson as json
+
+import fmri_gzip_index
+
+BLOCK_SIZE = fmri_gzip_index.SEEK_POINT_SPACING  # uncompressed bytes of a gzip member
+
+
+def compress_file(src, num_threads, level, index_dir=None):
+    """Compresses src to src.gz and removes src
+        Args:
+            src (string): uncompressed file, e.g. a .nii image
+            num_threads (int): threads compressing blocks
+            level (int): zlib compression level, 1 (fastest) to 9 (smallest)
+            index_dir (string): directory of the gzip seek-point indexes, None to not write the index
+        Returns:
+            stats (tuple): compressed file, uncompressed bytes, compressed bytes, seconds
+    """
+    start_time = time.time()
+    dst = src + '.gz'
+    tmp_file = dst + '.tmp'
+    seek_points = list()
+    compressed_offset = 0
+    uncompressed_offset = 0
+    pending = list()
+    with ThreadPoolExecutor(num_threads) as pool, open(src, 'rb') as src_fp, open(tmp_file, 'wb') as dst_fp:
+        while True:
+            data = src_fp.read(BLOCK_SIZE)
+            if data:
+                pending.append((len(data), pool.submit(gzip.compress, data, level)))
+            # At most two blocks per thread in flight
+            while pending and (len(pending) >= 2 * num_threads or not data):
+                size, future = pending.pop(0)
+                member = future.result()
+                seek_points.append([compressed_offset, uncompressed_offset])
+                dst_fp.write(member)
+                compressed_offset += len(member)
+                uncompressed_offset += size
+            if not data:
+                break
+        if not seek_points:
+            # An empty file is one empty member
+            dst_fp.write(gzip.compress(b'', level))
+            seek_points.append([0, 0])
+            compressed_offset = dst_fp.tell()
+    os.replace(tmp_file, dst)
+    os.remove(src)
+
+    if index_dir is not None:
+        os.makedirs(index_dir, exist_ok=True)
+        member_index = fmri_gzip_index.index_file(dst, index_dir, '.json')
+        with open(member_index + '.' + str(os.getpid()), 'w') as fp:
+            fp.write(json.dumps(seek_points))
+        os.replace(member_index + '.' + str(os.getpid()), member_index)
+    return dst, uncompressed_offset, compressed_offset, time.time() - start_time
+
+
+def compress_outputs(directory, **template_dict):
+    """Compresses every .nii file under directory, in a subject worker
+        Args:
+            directory (string): directory of nifti outputs, e.g. the fmri_out of a subject
+            template_dict ( dictionary) : Dictionary that stores all the paths, file names, software locations
+        Returns:
+            stats (list): compress_file stats of each file
+        Comments:
+            compression_num_threads=0 uses the worker's share of the cores, spm_num_threads from fmri_scheduler, so
+            that concurrent workers do not each start a thread per core of the host
+    """
+    num_threads = int(template_dict['compression_num_threads']) or int(template_dict['spm_num_threads'])
+    index_dir = os.path.join(template_dict['cache_dir'], template_dict['gzip_index_dirname'])
+    return [compress_file(nifti_file, num_threads, int(template_dict['compression_level']), index_dir) for nifti_file in
+            sorted(glob.glob(os.path.join(directory, '**', '*.nii'), recursive=True))]
+
+
+def compression_report(stats):
+    """Returns the sentence of the output message on the compressed outputs"""
+    if not stats:
+        return ''
+    uncompressed = sum([stat[1] for stat in stats]) / 1024.0 ** 2
+    compressed = sum([stat[2] for stat in stats]) / 1024.0 ** 2
+    seconds = sum([stat[3] for stat in stats])
+    return " Compressed %d nifti outputs from %.0f MB to %.0f MB in %.1f s (%.0f MB/s)." % (
+        len(stats), uncompressed, compressed, seconds, uncompressed / max(seconds, 1e-6))
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This layer converts the dicoms of all the subjects to nifti as a stage of its own, ahead of the SPM processing
+Conversions run in a thread pool in the order the subjects will be started, while subject k is processed the next
+subjects are converted. At most conversion_max_in_flight subjects are converted or converting without having started,
+which bounds the disk used by converted files waiting for a worker. A failed conversion is reported with its subject
+"""
+import threading, traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import fmri_subject_layer
+
+
+class ConversionPool:
+    """Converts the dicoms of subject_plans ahead of their processing, used as the input stage of
+    fmri_scheduler.run_subjects
+        Args:
+            subject_plans (list): SubjectPlan of each subject, in the order they will be started
+            write_dir (string): Directory to write outputs, the converted files go to the subjects' output directories
+            template_dict ( dictionary) : Dictionary that stores all the paths, file names, software locations
+    """
+
+    def __init__(self, subject_plans, write_dir, **template_dict):
+        self.queue = list(subject_plans)
+        self.write_dir = write_dir
+        self.template_dict = template_dict
+        self.max_in_flight = max(1, int(template_dict['conversion_max_in_flight']))
+        self.executor = ThreadPoolExecutor(max_workers=max(1, int(template_dict['conversion_num_threads'])))
+        self.in_flight = set()
+        self.converted = set()
+        self.lock = threading.Lock()
+        self.fill()
+
+    def convert(self, subject_plan):
+        try:
+            subject_plan.converted_file = fmri_subject_layer.convert_dicoms(
+                subject_plan, fmri_subject_layer.subject_output_dir(subject_plan, self.write_dir, 'dicoms'),
+                **self.template_dict)
+        except Exception as e:
+            subject_plan.conversion_error = 'Dicom conversion failed: ' + str(e) + str(traceback.format_exc())
+        with self.lock:
+            self.converted.add(subject_plan.index)
+
+    def fill(self):
+        """Starts the conversions of the next subjects while fewer than max_in_flight are waiting"""
+        while self.queue and len(self.in_flight) < self.max_in_flight:
+            subject_plan = self.queue.pop(0)
+            self.in_flight.add(subject_plan.index)
+            self.executor.submit(self.convert, subject_plan)
+
+    def ready(self, subject_plan):
+        """Returns True once the subject is converted"""
+        with self.lock:
+            return subject_plan.index in self.converted
+
+    def started(self, subject_plan):
+        """Called when the subject's processing starts, frees its place for the next conversion"""
+        self.in_flight.discard(subject_plan.index)
+        self.fill()
+
+    def shutdown(self):
+        self.queue = list()
+        self.executor.shutdown(wait=True)
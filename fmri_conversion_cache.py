@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This layer keeps the dicom to nifti conversions of earlier runs, so that a series exported again is not converted again
+An entry is keyed on the SeriesInstanceUID of the series and a fingerprint of its file count and sizes, and holds the
+files written by dcm2niix. Cached files are linked into the subject's output directory. The least recently used entries
+are evicted when the cache grows over conversion_cache_max_mb
+"""
+import os, shutil, hashlib
+
+
+def cache_root(**template_dict):
+    return os.path.join(template_dict['cache_dir'], template_dict['conversion_cache_dirname'])
+
+
+def series_key(dicom_series):
+    """Returns the cache key of a series, None when its SeriesInstanceUID is unknown"""
+    if not dicom_series.series_uid:
+        return None
+    fingerprint = hashlib.sha1(dicom_series.series_uid.encode('utf-8'))
+    fingerprint.update(str(dicom_series.num_instances).encode('utf-8'))
+    for size in sorted([os.path.getsize(file_path) for file_path in dicom_series.files]):
+        fingerprint.update(str(size).encode('utf-8'))
+    return fingerprint.hexdigest()
+
+
+def link_or_copy(src, dst):
+    """Hard links src to dst, copies it when the files are on different file systems"""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def lookup(key, output_dir, **template_dict):
+    """Links the cached files of key into output_dir, returns False when key is not cached"""
+    entry_dir = os.path.join(cache_root(**template_dict), key)
+    try:
+        file_names = os.listdir(entry_dir)
+    except OSError:
+        return False
+    os.makedirs(output_dir, exist_ok=True)
+    for file_name in file_names:
+        if os.path.exists(os.path.join(output_dir, file_name)):
+            continue
+        if file_name.endswith('.gz'):
+            link_or_copy(os.path.join(entry_dir, file_name), os.path.join(output_dir, file_name))
+        else:
+            # Uncompressed images may be rewritten in place by the pipeline, they must not share the cached file
+            shutil.copy2(os.path.join(entry_dir, file_name), os.path.join(output_dir, file_name))
+    # The modification time of an entry is its last use
+    os.utime(entry_dir, None)
+    return True
+
+
+def store(key, converted_files, **template_dict):
+    """Adds the files converted from the series key to the cache, then evicts the least recently used entries"""
+    root = cache_root(**template_dict)
+    entry_dir = os.path.join(root, key)
+    tmp_dir = entry_dir + '.' + str(os.getpid()) + '.' + str(id(converted_files))
+    os.makedirs(tmp_dir, exist_ok=True)
+    try:
+        for file_path in converted_files:
+            if file_path.endswith('.gz'):
+                link_or_copy(file_path, os.path.join(tmp_dir, os.path.basename(file_path)))
+            else:
+                # Same rule as lookup, the converted .nii is staged in place and reoriented, the cache keeps a copy
+                shutil.copy2(file_path, os.path.join(tmp_dir, os.path.basename(file_path)))
+        # The entry appears complete or not at all, a concurrent store of the same series keeps the first one
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    evict(**template_dict)
+
+
+def entry_size(entry_dir):
+    return sum([entry.stat().st_size for entry in os.scandir(entry_dir) if entry.is_file()])
+
+
+def evict(**template_dict):
+    """Removes the least recently used entries until the cache fits conversion_cache_max_mb"""
+    root = cache_root(**template_dict)
+    max_size = template_dict['conversion_cache_max_mb'] * 1024 ** 2
+    entries = list()
+    for entry in os.scandir(root):
+        # Entries being stored have a dotted name
+        if entry.is_dir() and '.' not in entry.name:
+            try:
+                entries.append((entry.stat().st_mtime, entry_size(entry.path), entry.path))
+            except OSError:
+                continue
+    total_size = sum([size for last_use, size, path in entries])
+    for last_use, size, path in sorted(entries):
+        if total_size <= max_size:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total_size = total_size - size
+
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This layer applies the output datatype policy, output_data_types, to the images each stage writes to the outputs
+A stage set to 'int16' has its float images quantised to int16 with a scale factor (scl_slope, scl_inter) after the
+pipeline ran, and the quantisation error is measured against the float images. The images are read and written a chunk
+of volumes at a time (fmri_image_io). Other datatypes are passed to SPM where the stage's interface has a data type
+field (Smooth), 'same' keeps what SPM writes
+"""
+import os, glob
+
+import numpy as np
+
+import fmri_image_io
+
+# SPM datatype codes of spm_type, 0 writes the datatype of the input image
+SPM_DATA_TYPES = {'same': 0, 'uint8': 2, 'int16': 4, 'int32': 8, 'float32': 16, 'float64': 64}
+
+# Prefix of the images of each stage in the output directories
+STAGE_PREFIXES = {'realign': 'r', 'slicetiming': 'a', 'normalize': 'wa', 'smooth': 'swa'}
+
+INT16_MIN = -32768
+INT16_MAX = 32767
+
+
+def spm_data_type(stage, **template_dict):
+    """Returns the SPM datatype code of a stage's images. An int16 stage gets float32 images from SPM, they are
+    quantised afterwards so that the error can be measured"""
+    data_type = template_dict['output_data_types'][stage]
+    if data_type == 'int16':
+        return SPM_DATA_TYPES['float32']
+    return SPM_DATA_TYPES[data_type]
+
+
+def int16_scaling(minimum, maximum):
+    """Returns the slope and intercept mapping [minimum, maximum] onto the int16 range"""
+    if maximum <= minimum:
+        return 1.0, float(minimum)
+    slope = (float(maximum) - float(minimum)) / (INT16_MAX - INT16_MIN)
+    return slope, float(minimum) - INT16_MIN * slope
+
+
+def quantise_file(nifti_file):
+    """Rewrites a float nifti image as int16 with a scale factor
+        Args:
+            nifti_file (string): uncompressed .nii image
+        Returns:
+            stats (tuple): nifti_file, max absolute error, rms error as a percentage of the rms of the float image
+    """
+    series = fmri_image_io.Volume4D(nifti_file)
+    if series.dtype.kind != 'f':
+        return nifti_file, 0.0, 0.0
+
+    # First pass for the range of the image, second pass writes the quantised volumes
+    minimum, maximum = np.inf, -np.inf
+    for start, volumes in series.iter_volumes():
+        volumes = np.nan_to_num(volumes)
+        minimum, maximum = min(minimum, float(volumes.min())), max(maximum, float(volumes.max()))
+    # The header stores the scale factor as float32, the error is measured with the stored values
+    slope, inter = [float(np.float32(value)) for value in int16_scaling(minimum, maximum)]
+
+    header = series.header.copy()
+    header.set_data_dtype(np.int16)
+    header.set_slope_inter(slope, inter)
+    header.set_data_offset(352)
+    max_error, squared_error, squared_signal = 0.0, 0.0, 0.0
+    tmp_file = nifti_file + '.int16'
+    with open(tmp_file, 'wb') as fp:
+        fp.write(header.binaryblock)
+        # No header extensions
+        fp.write(b'\x00' * (352 - len(header.binaryblock)))
+        for start, volumes in series.iter_volumes():
+            volumes = np.nan_to_num(np.asarray(volumes, dtype=np.float64))
+            quantised = np.clip(np.round((volumes - inter) / slope), INT16_MIN, INT16_MAX).astype(np.int16)
+            # Volumes are the last axis, the chunks are written one after the other in nifti (Fortran) order
+            fp.write(quantised.tobytes(order='F'))
+            error = quantised * slope + inter - volumes
+            max_error = max(max_error, float(np.abs(error).max()))
+            squared_error += float(np.sum(error ** 2))
+            squared_signal += float(np.sum(volumes ** 2))
+    os.replace(tmp_file, nifti_file)
+    return nifti_file, max_error, 100.0 * float(np.sqrt(squared_error / max(squared_signal, 1e-12)))
+
+
+def apply_output_data_types(output_dirs, **template_dict):
+    """Quantises the images of the int16 stages in output_dirs
+        Args:
+            output_dirs (list): directories of a subject's outputs
+            template_dict ( dictionary) : Dictionary that stores all the paths, file names, software locations
+        Returns:
+            stats (list): quantise_file stats of each image
+    """
+    stats = list()
+    for stage, data_type in sorted(template_dict['output_data_types'].items()):
+        if data_type != 'int16':
+            continue
+        for output_dir in output_dirs:
+            for nifti_file in sorted(glob.glob(os.path.join(output_dir, STAGE_PREFIXES[stage] + '*.nii'))):
+                stats.append(quantise_file(nifti_file))
+    return stats
+
+
+def quantisation_report(stats):
+    """Returns the sentence of the output message on the quantised outputs"""
+    if not stats:
+        return ''
+    return " Quantised %d outputs to int16, largest error %.4g, largest rms error %.3f%% of the float images." % (
+        len(stats), max([stat[1] for stat in stats]), max([stat[2] for stat in stats]))
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This layer detects dicom directories and indexes the series they hold
+A file is a dicom if it has the 128-byte preamble followed by the DICM magic, only those 132 bytes are read. Directories
+are scanned in parallel threads with os.scandir and the headers are read without the pixel data to index the series
+(SeriesInstanceUID, number of instances, TR) of each directory. The index drives the dicom to nifti conversion and
+rejects directories mixing several series before dcm2niix runs
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+DICOM_PREAMBLE_LENGTH = 128
+DICOM_MAGIC = b'DICM'
+
+
+def is_dicom(file_path):
+    """Returns True if the file has the dicom preamble and magic"""
+    try:
+        with open(file_path, 'rb') as fp:
+            return fp.read(DICOM_PREAMBLE_LENGTH + len(DICOM_MAGIC))[DICOM_PREAMBLE_LENGTH:] == DICOM_MAGIC
+    except (IOError, OSError):
+        return False
+
+
+def dicom_files(dicom_dir, first_only=False):
+    """Returns the dicom files of a directory, sorted by name, only the first one found if first_only"""
+    files = list()
+    try:
+        entries = sorted(os.scandir(dicom_dir), key=lambda entry: entry.name)
+    except (IOError, OSError):
+        return files
+    for entry in entries:
+        if entry.is_file() and is_dicom(entry.path):
+            files.append(entry.path)
+            if first_only:
+                break
+    return files
+
+
+def find_dicom_dirs(dirs, num_threads=8):
+    """Returns the directories among dirs holding at least one dicom file, in the order of dirs"""
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        found = list(executor.map(lambda dicom_dir: bool(dicom_files(dicom_dir, first_only=True)), dirs))
+    return [dicom_dir for dicom_dir, has_dicoms in zip(dirs, found) if has_dicoms]
+
+
+class DicomSeries:
+    """One series of a dicom directory"""
+
+    def __init__(self, series_uid, repetition_time=None):
+        self.series_uid = series_uid
+        self.repetition_time = repetition_time  # in ms, as stored in the dicom header
+        self.files = list()
+
+    @property
+    def num_instances(self):
+        return len(self.files)
+
+
+def index_dicom_dir(dicom_dir):
+    """Returns the series of a dicom directory, largest first. Headers are read without the pixel data, all the files
+    form one series with an unknown SeriesInstanceUID if a header can not be read"""
+    import pydicom
+    series = dict()
+    files = dicom_files(dicom_dir)
+    try:
+        for file_path in files:
+            header = pydicom.dcmread(file_path, stop_before_pixels=True,
+                                     specific_tags=['SeriesInstanceUID', 'RepetitionTime'])
+            series_uid = str(getattr(header, 'SeriesInstanceUID', ''))
+            if series_uid not in series:
+                repetition_time = getattr(header, 'RepetitionTime', None)
+                series[series_uid] = DicomSeries(series_uid,
+                                                 float(repetition_time) if repetition_time is not None else None)
+            series[series_uid].files.append(file_path)
+    except Exception:
+        series = {'': DicomSeries('')}
+        series[''].files = files
+    return sorted(series.values(), key=lambda dicom_series: dicom_series.num_instances, reverse=True)
+
+
+def check_single_series(dicom_dir, series):
+    """Raises ValueError if the directory holds no dicom or several series, dcm2niix would otherwise convert them into
+    several nifti files"""
+    if not series or not series[0].files:
+        raise ValueError('No dicom files found in ' + str(dicom_dir))
+    if len(series) > 1:
+        raise ValueError('Dicom directory ' + str(dicom_dir) + ' mixes ' + str(len(series)) + ' series: ' + ', '.join(
+            [dicom_series.series_uid + ' (' + str(dicom_series.num_instances) + ' instances)' for dicom_series in
+             series]))
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This layer renders the display image of a subject from the middle volume of its normalized series
+The image is rendered with nilearn's plot_anat, or with display_renderer='png' as the three orthogonal slices through
+cut_coords written straight to a grayscale PNG without the matplotlib stack. Rendered images are cached in cache_dir,
+keyed on a hash of the middle volume, its affine and the render options, so that the same outputs rendered again are
+copied from the cache. The least recently used images are evicted when the cache grows over display_cache_max_mb
+"""
+import os, shutil, struct, zlib, hashlib
+
+import numpy as np
+
+import fmri_image_io
+
+
+def png_bytes(image):
+    """Returns the PNG file of a 2D uint8 grayscale image"""
+    height, width = image.shape
+
+    def chunk(chunk_type, data):
+        return struct.pack('>I', len(data)) + chunk_type + data + struct.pack(
+            '>I', zlib.crc32(chunk_type + data) & 0xffffffff)
+
+    # Every row starts with filter type 0 (none)
+    rows = np.hstack([np.zeros((height, 1), dtype=np.uint8), image.astype(np.uint8)])
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)) + chunk(
+        b'IDAT', zlib.compress(rows.tobytes(), 6)) + chunk(b'IEND', b'')
+
+
+def ortho_slices(volume, affine, cut_coords):
+    """Returns the sagittal, coronal and axial slices of volume through the world coordinates cut_coords, oriented with
+    the top of the head up, for a volume stored in the usual RAS+ voxel order"""
+    voxel = np.round(np.linalg.inv(affine).dot(list(cut_coords) + [1])[:3]).astype(int)
+    voxel = np.clip(voxel, 0, np.array(volume.shape[:3]) - 1)
+    sagittal = volume[voxel[0], :, :]
+    coronal = volume[:, voxel[1], :]
+    axial = volume[:, :, voxel[2]]
+    # Rows of the image are the last voxel axis reversed, so that superior/anterior is up
+    return [np.flipud(np.asarray(view).T) for view in (sagittal, coronal, axial)]
+
+
+def ortho_png(volume, affine, cut_coords):
+    """Returns the PNG of the three orthogonal slices side by side, intensities scaled to the 2-98th percentiles"""
+    views = ortho_slices(volume, affine, cut_coords)
+    height = max([view.shape[0] for view in views])
+    mosaic = np.hstack([np.pad(view, ((0, height - view.shape[0]), (0, 0)), mode='constant') for view in views])
+    mosaic = np.nan_to_num(mosaic.astype(np.float32))
+    low, high = np.percentile(mosaic[mosaic != 0], [2, 98]) if np.any(mosaic != 0) else (0.0, 1.0)
+    return png_bytes(np.clip((mosaic - low) * 255.0 / max(high - low, 1e-6), 0, 255))
+
+
+def render_key(volume, affine, label, **template_dict):
+    """Returns the hash identifying a rendering of volume with the current display options"""
+    key = hashlib.sha1(np.ascontiguousarray(volume).tobytes())
+    key.update(str(volume.dtype).encode('utf-8') + str(volume.shape).encode('utf-8'))
+    key.update(np.ascontiguousarray(affine, dtype=np.float64).tobytes())
+    key.update('|'.join([label, template_dict['display_renderer'], str(template_dict['cut_coords']),
+                         template_dict['display_pngimage_name']]).encode('utf-8'))
+    return key.hexdigest()
+
+
+def evict(image_dir, **template_dict):
+    """Removes the least recently used images until the cache fits display_cache_max_mb"""
+    max_size = template_dict['display_cache_max_mb'] * 1024 ** 2
+    entries = list()
+    for entry in os.scandir(image_dir):
+        # Images being stored have a pid suffix
+        if entry.is_file() and entry.name.endswith('.png'):
+            try:
+                entries.append((entry.stat().st_mtime, entry.stat().st_size, entry.path))
+            except OSError:
+                continue
+    total_size = sum([size for last_use, size, path in entries])
+    for last_use, size, path in sorted(entries):
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total_size = total_size - size
+
+
+def render_display_image(source_file, output_file, label, **template_dict):
+    """Renders the middle volume of source_file to output_file, copies the cached rendering when there is one
+        Args:
+            source_file (string): normalized 4D series
+            output_file (string): PNG file written
+            label (string): sub-id and session of the subject, in the title of the nilearn rendering
+            template_dict ( dictionary) : Dictionary that stores all the paths, file names, software locations
+    """
+    # Only the middle volume of the series is read
+    series = fmri_image_io.Volume4D(source_file, os.path.join(template_dict['cache_dir'],
+                                                              template_dict['gzip_index_dirname']))
+    volume = np.asarray(series.volume(int(series.num_volumes / 2)))
+
+    cache_dir = os.path.join(template_dict['cache_dir'], template_dict['display_cache_dirname'])
+    cached_file = os.path.join(cache_dir, render_key(volume, series.affine, label, **template_dict) + '.png')
+    if os.path.isfile(cached_file):
+        shutil.copyfile(cached_file, output_file)
+        # The modification time of an image is its last use
+        os.utime(cached_file, None)
+        return
+
+    if template_dict['display_renderer'] == 'png':
+        with open(output_file, 'wb') as fp:
+            fp.write(ortho_png(volume, series.affine, template_dict['cut_coords']))
+    else:
+        import nibabel as nib
+        from nilearn import plotting
+        plotting.plot_anat(
+            nib.Nifti1Image(volume, series.affine),
+            cut_coords=template_dict['cut_coords'],
+            annotate=False,
+            draw_cross=False,
+            output_file=output_file,
+            display_mode='ortho',
+            title=label + ' ' + template_dict['display_pngimage_name'],
+            colorbar=False)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    shutil.copyfile(output_file, cached_file + '.' + str(os.getpid()))
+    os.replace(cached_file + '.' + str(os.getpid()), cached_file)
+    evict(cache_dir, **template_dict)
@@ -10,10 +10,20 @@ import nipype.interfaces.spm.utils as spmu
 spm.terminal_output = 'file'
 from nipype.interfaces.io import DataSink
 
+import fmri_datatype
+
 #Stop printing nipype.workflow info to stdout
 from nipype import logging
 logging.getLogger('nipype.workflow').setLevel('CRITICAL')
 
+
+def limit_spm_threads(node, **template_dict):
+    """Adds maxNumCompThreads to the batch generated for an SPM node when the worker was given a thread budget"""
+    if template_dict.get('spm_num_threads'):
+        node.interface.mlab.inputs.prescript = ["ver,", "maxNumCompThreads(%d);" % int(
+            template_dict['spm_num_threads']), "try,"]
+
+
 ## 1 Reorientation node & settings ##
 class Reorient:
     def __init__(self, nifti_file, **template_dict):
@@ -37,31 +47,51 @@ class Realign:
         self.node.inputs.write_mask = template_dict['options_realign_write_mask']
         self.node.inputs.write_which = template_dict['options_realign_write_which']
         self.node.inputs.write_wrap = template_dict['options_realign_write_wrap']
+        limit_spm_threads(self.node, **template_dict)
 
 ## 3 Slicetiming Node and settings ##
 class Slicetiming:
     def __init__(self, **template_dict):
         self.node = pe.Node(interface=spm.SliceTiming(), name='slicetiming')
         self.node.inputs.paths = template_dict['spm_path']
+        limit_spm_threads(self.node, **template_dict)
 
 ## 4 Normalize Node and settings ##
 class Normalize:
-    def __init__(self, **template_dict):
-        self.node = pe.Node(interface=spm.Normalize12(), name='normalize')
+    def __init__(self, name='normalize', **template_dict):
+        self.node = pe.Node(interface=spm.Normalize12(), name=name)
         self.node.inputs.tpm = template_dict['tpm_path']
         self.node.inputs.affine_regularization_type = template_dict['options_normalize_affine_regularization_type']
         self.node.inputs.write_bounding_box = template_dict['options_normalize_write_bounding_box']
         self.node.inputs.write_interp = template_dict['options_normalize_write_interp']
         self.node.inputs.write_voxel_sizes = template_dict['options_normalize_write_voxel_sizes']
+        limit_spm_threads(self.node, **template_dict)
 
+## 4a Normalize estimate-only node, shared by all the variants of a parameter sweep ##
+class NormalizeEstimate(Normalize):
+    def __init__(self, **template_dict):
+        Normalize.__init__(self, name='normalize_estimate', **template_dict)
+        self.node.inputs.jobtype = 'est'
+
+## 4b Normalize write node for one variant of a parameter sweep, uses the deformation from NormalizeEstimate ##
+class NormalizeWrite:
+    def __init__(self, name='normalize_write', **template_dict):
+        self.node = pe.Node(interface=spm.Normalize12(), name=name)
+        self.node.inputs.jobtype = 'write'
+        self.node.inputs.write_bounding_box = template_dict['options_normalize_write_bounding_box']
+        self.node.inputs.write_interp = template_dict['options_normalize_write_interp']
+        self.node.inputs.write_voxel_sizes = template_dict['options_normalize_write_voxel_sizes']
+        limit_spm_threads(self.node, **template_dict)
 
 ## 5 Smoothing Node & Settings ##
 class Smooth:
-    def __init__(self, **template_dict):
-        self.node = pe.Node(interface=spm.Smooth(), name='smoothing')
+    def __init__(self, name='smoothing', **template_dict):
+        self.node = pe.Node(interface=spm.Smooth(), name=name)
         self.node.inputs.paths = template_dict['spm_path']
         self.node.inputs.fwhm = template_dict['FWHM_SMOOTH']
         self.node.inputs.implicit_masking=template_dict['options_smoothing_implicit_masking']
+        self.node.inputs.data_type = fmri_datatype.spm_data_type('smooth', **template_dict)
+        limit_spm_threads(self.node, **template_dict)
 
 ## 5 Datsink Node that collects segmented, smoothed files and writes to temp_write_dir ##
 class Datasink:
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This layer gives random access into .nii.gz files through a seek-point index, so that reading one volume only
+decompresses from the nearest seek point instead of from the start of the file
+The index is built once per file in a single streaming pass and stored in a cache directory, keyed on the file's path,
+size and mtime. Files written as concatenated gzip members (fmri_compression) get a seek point at each member, which
+only needs python's zlib. A file whose first member runs past the seek point spacing, e.g. a scanner's single-member
+.nii.gz, is recognised without decompressing the rest of it. Such files are indexed with indexed_gzip (zran) if it is
+installed, and are otherwise read as a stream
+"""
+import os, io, gzip, zlib, hashlib, warnings
+with warnings.catch_warnings():
+    warnings.filterwarnings("ignore")
+import ujson as json
+
+# if available build zran indexes of single-member gzip files
+try:
+    import indexed_gzip
+except ImportError:
+    indexed_gzip = None
+
+SEEK_POINT_SPACING = 4 * 1024 ** 2  # uncompressed bytes between seek points
+READ_SIZE = 1024 ** 2
+
+
+def index_file(file_path, index_dir, extension):
+    """Returns the path of the index of file_path in index_dir, the name changes with the file's size and mtime"""
+    stat = os.stat(file_path)
+    key = hashlib.sha1((os.path.abspath(file_path) + ':' + str(stat.st_size) + ':' + str(stat.st_mtime)).encode(
+        'utf-8')).hexdigest()
+    return os.path.join(index_dir, key + extension)
+
+
+def build_member_index(file_path, spacing=SEEK_POINT_SPACING):
+    """Returns the [compressed offset, uncompressed offset] seek points of a gzip file, one at the start of each member
+    at least spacing uncompressed bytes after the previous seek point, in one streaming pass. The pass stops with the
+    single seek point [0, 0] when the first member is longer than spacing, the file is then read from its start
+    """
+    if os.path.getsize(file_path) == 0:
+        raise ValueError('Empty gzip file: ' + file_path)
+    seek_points = [[0, 0]]
+    num_members = 0
+    compressed_offset = 0
+    uncompressed_offset = 0
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    with open(file_path, 'rb') as fp:
+        while True:
+            data = fp.read(READ_SIZE)
+            if not data:
+                break
+            while data:
+                uncompressed_offset += len(decompressor.decompress(data))
+                if not decompressor.eof:
+                    compressed_offset += len(data)
+                    if num_members == 0 and uncompressed_offset > spacing:
+                        # A single long member has no seek point to find, the rest is not decompressed
+                        return seek_points
+                    break
+                # End of a member, the rest of data starts the next one
+                num_members += 1
+                compressed_offset += len(data) - len(decompressor.unused_data)
+                data = decompressor.unused_data
+                decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                if uncompressed_offset - seek_points[-1][1] >= spacing:
+                    seek_points.append([compressed_offset, uncompressed_offset])
+    if len(seek_points) > 1 and seek_points[-1][0] >= compressed_offset:
+        # No seek point at the end of the file, [0, 0] is kept for files of a single short member
+        seek_points.pop()
+    return seek_points
+
+
+class MemberIndexedFile(io.RawIOBase):
+    """Read-only file object over a multi-member gzip file, seeking restarts decompression at the nearest seek point"""
+
+    def __init__(self, file_path, seek_points):
+        self.file_path = file_path
+        self.seek_points = seek_points
+        self.stream = None
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset = self.position + offset
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation('seek from the end of a gzip file')
+        if self.stream is None or offset < self.position or offset - self.position > SEEK_POINT_SPACING:
+            compressed_offset, uncompressed_offset = [point for point in self.seek_points if point[1] <= offset][-1]
+            if self.stream is not None:
+                self.stream.close()
+            raw = open(self.file_path, 'rb')
+            raw.seek(compressed_offset)
+            self.stream = gzip.GzipFile(fileobj=raw, mode='rb')
+            self.raw = raw
+            self.position = uncompressed_offset
+        # Skip forward from the seek point
+        while self.position < offset:
+            skipped = len(self.stream.read(min(READ_SIZE, offset - self.position)))
+            if not skipped:
+                break
+            self.position += skipped
+        return self.position
+
+    def read(self, size=-1):
+        if self.stream is None:
+            self.seek(self.position)
+        data = self.stream.read(size)
+        self.position += len(data)
+        return data
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.raw.close()
+            self.stream = None
+        io.RawIOBase.close(self)
+
+
+def open_indexed(file_path, index_dir):
+    """Opens a .nii.gz file for random access, building its seek-point index in index_dir on first use
+        Args:
+            file_path (string): gzip compressed file
+            index_dir (string): directory storing the indexes, None to read the file as a stream
+        Returns:
+            a binary file object supporting fast seek and read
+    """
+    if index_dir is None:
+        return gzip.open(file_path, 'rb')
+    os.makedirs(index_dir, exist_ok=True)
+    member_index = index_file(file_path, index_dir, '.json')
+    try:
+        with open(member_index) as fp:
+            seek_points = json.loads(fp.read())
+    except (IOError, OSError, ValueError):
+        seek_points = build_member_index(file_path)
+        tmp_file = member_index + '.' + str(os.getpid())
+        with open(tmp_file, 'w') as fp:
+            fp.write(json.dumps(seek_points))
+        os.replace(tmp_file, member_index)
+    if len(seek_points) > 1 or indexed_gzip is None:
+        return MemberIndexedFile(file_path, seek_points)
+
+    # A single member, zran seek points need the decompressor state saved by indexed_gzip
+    zran_index = index_file(file_path, index_dir, '.zran')
+    indexed_file = indexed_gzip.IndexedGzipFile(file_path, spacing=SEEK_POINT_SPACING)
+    if os.path.isfile(zran_index):
+        indexed_file.import_index(zran_index)
+    else:
+        indexed_file.build_full_index()
+        indexed_file.export_index(zran_index + '.' + str(os.getpid()))
+        os.replace(zran_index + '.' + str(os.getpid()), zran_index)
+    return indexed_file
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This layer limits the number of SPM stages running at once on a host, across all the COINSTAC runs sharing it
+Every run acquires a slot before launching an SPM stage. Slots and waiting tickets are files in a directory shared by the
+containers of the host, held with flock so that the kernel frees the locks of crashed containers and the leftover files
+are recovered by the next run scanning the directory
+Free slots go to the waiting tickets with the highest priority first, then to the runs holding the fewest slots compared
+to their fair share of host_slot_limit, then to the oldest tickets
+"""
+import os, time, socket, fcntl, errno, warnings
+with warnings.catch_warnings():
+    warnings.filterwarnings("ignore")
+import ujson as json
+
+POLL_INTERVAL = 1.0  # seconds between attempts to take a slot
+
+
+def try_lock(fd):
+    """Returns True if the exclusive lock on fd was taken without blocking"""
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except (IOError, OSError) as e:
+        if e.errno in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK):
+            return False
+        raise
+
+
+def read_lock_file(fd):
+    """Returns the json content of a slot or ticket file, an empty dict if it has none"""
+    try:
+        os.lseek(fd, 0, os.SEEK_SET)
+        return json.loads(os.read(fd, 4096).decode('utf-8') or '{}')
+    except (OSError, ValueError):
+        return dict()
+
+
+def write_lock_file(fd, content):
+    os.ftruncate(fd, 0)
+    os.lseek(fd, 0, os.SEEK_SET)
+    os.write(fd, json.dumps(content).encode('utf-8'))
+
+
+class HostSlots:
+    """Host-wide SPM slot limiter
+        Args:
+            slot_dir (string): directory shared by all the containers of the host
+            limit (int): maximum number of SPM stages running at once on the host
+            priority (int): runs with a higher priority get free slots first
+            run_id (string): identifies the run for fair sharing, defaults to the hostname and pid of the run
+    """
+
+    def __init__(self, slot_dir, limit, priority=0, run_id=None):
+        self.slot_dir = slot_dir
+        self.limit = max(1, int(limit))
+        self.priority = priority
+        self.run_id = run_id or socket.gethostname() + '-' + str(os.getppid())
+        self.slot_fd = None
+        os.makedirs(slot_dir, exist_ok=True)
+
+    def slot_file(self, slot):
+        return os.path.join(self.slot_dir, 'slot-' + str(slot) + '.lock')
+
+    def scan_slots(self):
+        """Returns the free slots and the number of slots held by each run"""
+        free_slots = list()
+        held_slots = dict()
+        for slot in range(self.limit):
+            fd = os.open(self.slot_file(slot), os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                if try_lock(fd):
+                    # Nobody holds the slot, a crashed holder's lock was freed by the kernel
+                    free_slots.append(slot)
+                else:
+                    run_id = read_lock_file(fd).get('run_id', '')
+                    held_slots[run_id] = held_slots.get(run_id, 0) + 1
+            finally:
+                os.close(fd)
+        return free_slots, held_slots
+
+    def scan_tickets(self):
+        """Returns the tickets of the live waiters, removes the tickets left by crashed waiters"""
+        tickets = list()
+        for file_name in os.listdir(self.slot_dir):
+            if not file_name.endswith('.ticket'):
+                continue
+            ticket_file = os.path.join(self.slot_dir, file_name)
+            try:
+                fd = os.open(ticket_file, os.O_RDWR)
+            except OSError:
+                continue
+            try:
+                if try_lock(fd):
+                    # The waiter holding the ticket is gone
+                    os.remove(ticket_file)
+                else:
+                    ticket = read_lock_file(fd)
+                    ticket['file'] = ticket_file
+                    tickets.append(ticket)
+            except OSError:
+                pass
+            finally:
+                os.close(fd)
+        return tickets
+
+    def acquire(self):
+        """Blocks until a host slot is held by this process"""
+        if self.slot_fd is not None:
+            return
+        ticket_file = os.path.join(self.slot_dir, self.run_id + '-' + str(os.getpid()) + '.ticket')
+        # The ticket is locked before it gets its .ticket name, so that it is never taken for a crashed waiter's ticket
+        ticket_fd = os.open(ticket_file + '.new', os.O_RDWR | os.O_CREAT, 0o666)
+        fcntl.flock(ticket_fd, fcntl.LOCK_EX)
+        write_lock_file(ticket_fd, {'run_id': self.run_id, 'priority': self.priority, 'time': time.time()})
+        os.rename(ticket_file + '.new', ticket_file)
+        queue_fd = os.open(os.path.join(self.slot_dir, 'queue.lock'), os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            while self.slot_fd is None:
+                fcntl.flock(queue_fd, fcntl.LOCK_EX)
+                try:
+                    free_slots, held_slots = self.scan_slots()
+                    tickets = self.scan_tickets()
+                    active_runs = set(held_slots.keys()) | set([ticket.get('run_id') for ticket in tickets])
+                    fair_share = max(1, self.limit // max(1, len(active_runs)))
+                    tickets.sort(key=lambda ticket: (
+                        -ticket.get('priority', 0),
+                        held_slots.get(ticket.get('run_id'), 0) >= fair_share,
+                        held_slots.get(ticket.get('run_id'), 0),
+                        ticket.get('time', 0)))
+                    rank = [ticket['file'] for ticket in tickets].index(ticket_file)
+                    if rank < len(free_slots):
+                        slot_fd = os.open(self.slot_file(free_slots[rank]), os.O_RDWR | os.O_CREAT, 0o666)
+                        if try_lock(slot_fd):
+                            write_lock_file(slot_fd, {'run_id': self.run_id, 'pid': os.getpid(),
+                                                      'host': socket.gethostname(), 'time': time.time()})
+                            self.slot_fd = slot_fd
+                        else:
+                            os.close(slot_fd)
+                finally:
+                    fcntl.flock(queue_fd, fcntl.LOCK_UN)
+                if self.slot_fd is None:
+                    time.sleep(POLL_INTERVAL)
+        finally:
+            os.close(queue_fd)
+            os.remove(ticket_file)
+            os.close(ticket_fd)
+
+    def release(self):
+        """Frees the slot held by this process"""
+        if self.slot_fd is not None:
+            os.ftruncate(self.slot_fd, 0)
+            os.close(self.slot_fd)
+            self.slot_fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This layer reads 4D nifti images in bounded memory, it is the I/O primitive of the python-side stages and QC metrics
+A Volume4D only holds the header, affine and shape of the image. Uncompressed images are memory-mapped and volumes,
+slices and voxel blocks are returned as views of the map, without copies when the image has no intensity scaling.
+Compressed images are decompressed as a stream, at most a chunk of volumes at a time, single volumes are read from the
+nearest seek point of the fmri_gzip_index index when an index directory is given
+"""
+import gzip
+import numpy as np
+
+import fmri_gzip_index
+
+# Volumes held in memory at once by the iterators of compressed images
+DEFAULT_CHUNK_VOLUMES = 8
+
+
+class Volume4D:
+    """Header-only handle on a 3D or 4D nifti image, a 3D image is a series of one volume
+        Args:
+            filename (string): .nii or .nii.gz image
+            index_dir (string): directory of the gzip seek-point indexes, None to read compressed images as a stream
+        e.g.:
+            image = Volume4D('func.nii.gz')
+            middle = image.volume(image.num_volumes // 2)
+            for start, chunk in image.iter_volumes(4):
+                ...
+    """
+
+    __slots__ = ['filename', 'header', 'affine', 'shape', 'dtype', 'offset', 'slope', 'inter', 'compressed',
+                 'index_dir']
+
+    def __init__(self, filename, index_dir=None):
+        import nibabel as nib
+        image = nib.load(filename)
+        self.filename = filename
+        self.header = image.header
+        self.affine = image.affine
+        shape = tuple(int(dim) for dim in image.header.get_data_shape())
+        self.shape = shape[:3] + (shape[3] if len(shape) > 3 else 1,)
+        self.dtype = image.header.get_data_dtype()
+        # The array proxy holds the offset and scaling nibabel resolved from the header
+        self.offset = int(image.dataobj.offset)
+        slope, inter = image.dataobj.slope, image.dataobj.inter
+        self.slope = 1.0 if slope is None or np.isnan(slope) else float(slope)
+        self.inter = 0.0 if inter is None or np.isnan(inter) else float(inter)
+        self.compressed = filename.endswith('.gz')
+        self.index_dir = index_dir
+
+    @property
+    def num_volumes(self):
+        return self.shape[3]
+
+    @property
+    def volume_bytes(self):
+        return int(np.prod(self.shape[:3])) * self.dtype.itemsize
+
+    def scaled(self, data):
+        """Applies the intensity scaling of the header, returns data itself when there is none"""
+        if self.slope == 1.0 and self.inter == 0.0:
+            return data
+        return data * np.float32(self.slope) + np.float32(self.inter)
+
+    def memmap(self):
+        """Returns the raw data of an uncompressed image mapped in memory, in nifti (Fortran) order"""
+        if self.compressed:
+            raise ValueError('Can not memory-map the compressed image ' + str(self.filename))
+        return np.memmap(self.filename, dtype=self.dtype, mode='r', offset=self.offset, shape=self.shape, order='F')
+
+    def read_volumes(self, fp, count):
+        """Reads count volumes from a stream positioned on a volume"""
+        data = fp.read(self.volume_bytes * count)
+        count = len(data) // self.volume_bytes
+        return np.frombuffer(data, dtype=self.dtype, count=count * self.volume_bytes // self.dtype.itemsize).reshape(
+            self.shape[:3] + (count,), order='F')
+
+    def volume(self, index):
+        """Returns one volume, only that volume is read"""
+        if not self.compressed:
+            return self.scaled(self.memmap()[..., index])
+        with fmri_gzip_index.open_indexed(self.filename, self.index_dir) as fp:
+            # Decompression starts from the nearest seek point, the skipped volumes are not kept
+            fp.seek(self.offset + index * self.volume_bytes)
+            return self.scaled(self.read_volumes(fp, 1)[..., 0])
+
+    def iter_raw_volumes(self, chunk_volumes=DEFAULT_CHUNK_VOLUMES):
+        """Yields (first volume index, volumes) chunks of unscaled data"""
+        if not self.compressed:
+            data = self.memmap()
+            for start in range(0, self.num_volumes, chunk_volumes):
+                yield start, data[..., start:start + chunk_volumes]
+            return
+        with gzip.open(self.filename, 'rb') as fp:
+            fp.seek(self.offset)
+            for start in range(0, self.num_volumes, chunk_volumes):
+                yield start, self.read_volumes(fp, min(chunk_volumes, self.num_volumes - start))
+
+    def iter_volumes(self, chunk_volumes=DEFAULT_CHUNK_VOLUMES):
+        """Yields (first volume index, volumes) chunks of at most chunk_volumes volumes, in order"""
+        for start, volumes in self.iter_raw_volumes(chunk_volumes):
+            yield start, self.scaled(volumes)
+
+    def iter_slices(self, axis=2, chunk_volumes=DEFAULT_CHUNK_VOLUMES):
+        """Yields (volume index, slice index, slice) for every slice along axis of every volume"""
+        for start, volumes in self.iter_volumes(chunk_volumes):
+            for offset in range(volumes.shape[3]):
+                for index in range(self.shape[axis]):
+                    yield start + offset, index, volumes[(slice(None),) * axis + (index, offset)]
+
+    def iter_blocks(self, block_shape):
+        """Yields (x, y, z start, block) voxel blocks of block_shape holding every volume, e.g. to compute voxelwise
+        time series statistics. The blocks of a compressed image are read one slab of z at a time, with one pass of
+        decompression per slab"""
+        bx, by, bz = block_shape
+        for z in range(0, self.shape[2], bz):
+            if self.compressed:
+                slab = np.concatenate([volumes[:, :, z:z + bz, :] for start, volumes in
+                                       self.iter_raw_volumes()], axis=3)
+            else:
+                slab = self.memmap()[:, :, z:z + bz, :]
+            for x in range(0, self.shape[0], bx):
+                for y in range(0, self.shape[1], by):
+                    yield (x, y, z), self.scaled(slab[x:x + bx, y:y + by])
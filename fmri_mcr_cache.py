@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This layer manages MCR_CACHE_ROOT, the directory where the MATLAB runtime unpacks the SPM standalone on its first start
+A seed cache is warmed once by the first MCR start of the container, each worker then gets its own cache root seeded
+with a copy of the warm seed, so that concurrent MCR processes neither unpack SPM again nor contend on one cache lock
+Worker caches are kept in cache_dir and reused by the next runs. Cold and warm MCR start times are recorded and reported
+The SPM version found by the startup check is cached too, so that a run does not start MCR only to read the version
+"""
+import os, time, shutil, fcntl, warnings
+with warnings.catch_warnings():
+    warnings.filterwarnings("ignore")
+import ujson as json
+
+import fmri_host_slots
+
+SEEDED_MARKER = '.seeded'  # written in a cache root once it is complete
+
+
+def mcr_cache_dir(**template_dict):
+    return os.path.join(template_dict['cache_dir'], template_dict['mcr_cache_dirname'])
+
+
+def read_start_times(**template_dict):
+    """Returns the recorded cold and warm MCR start times in seconds"""
+    try:
+        with open(os.path.join(mcr_cache_dir(**template_dict), 'start_times.json')) as fp:
+            return json.loads(fp.read())
+    except (IOError, OSError, ValueError):
+        return dict()
+
+
+def write_start_time(key, seconds, **template_dict):
+    start_times = read_start_times(**template_dict)
+    start_times[key] = seconds
+    tmp_file = os.path.join(mcr_cache_dir(**template_dict), 'start_times.json.' + str(os.getpid()))
+    with open(tmp_file, 'w') as fp:
+        fp.write(json.dumps(start_times))
+    os.replace(tmp_file, os.path.join(mcr_cache_dir(**template_dict), 'start_times.json'))
+
+
+def warm_seed_cache(start_mcr, **template_dict):
+    """Runs start_mcr with the seed cache as MCR_CACHE_ROOT, the first call unpacks SPM into the seed (cold start), the
+    next ones find it warm. Containers starting at once wait for the one warming the seed
+        Args:
+            start_mcr (function): starts the MATLAB runtime, e.g. the SPM version check
+            template_dict ( dictionary) : Dictionary that stores all the paths, file names, software locations
+        Returns:
+            the return value of start_mcr
+    """
+    seed_dir = os.path.join(mcr_cache_dir(**template_dict), 'seed')
+    os.makedirs(seed_dir, exist_ok=True)
+    os.environ['MCR_CACHE_ROOT'] = seed_dir
+    lock_fd = os.open(os.path.join(mcr_cache_dir(**template_dict), 'seed.lock'), os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        cold = not os.path.isfile(os.path.join(seed_dir, SEEDED_MARKER))
+        if not cold:
+            fcntl.flock(lock_fd, fcntl.LOCK_UN)
+        start_time = time.time()
+        result = start_mcr()
+        write_start_time('cold_start_time' if cold else 'warm_start_time', time.time() - start_time, **template_dict)
+        if cold:
+            open(os.path.join(seed_dir, SEEDED_MARKER), 'w').close()
+        return result
+    finally:
+        os.close(lock_fd)
+
+
+def install_key(**template_dict):
+    """Returns the SPM and MCR install paths with their modification times, the cached SPM version is only valid for
+    this key"""
+    paths = [path for path in template_dict['matlab_cmd'].split() if os.path.isabs(path)] + [template_dict['spm_path']]
+    key = list()
+    for path in paths:
+        try:
+            key.append([path, os.stat(path).st_mtime])
+        except OSError:
+            key.append([path, None])
+    return key
+
+
+def cached_spm_version(probe, force=False, **template_dict):
+    """Returns the SPM version cached for the current install, runs probe to find it when the install changed, nothing is
+    cached or force is set. The probe also runs while the MCR cache seed is not warm, to warm it
+        Args:
+            probe (function): starts SPM and returns its version
+            force (bool): ignore the cached version
+            template_dict ( dictionary) : Dictionary that stores all the paths, file names, software locations
+    """
+    version_file = os.path.join(mcr_cache_dir(**template_dict), 'spm_version.json')
+    key = install_key(**template_dict)
+    seed_warm = os.path.isfile(os.path.join(mcr_cache_dir(**template_dict), 'seed', SEEDED_MARKER))
+    if not force and seed_warm:
+        try:
+            with open(version_file) as fp:
+                cached = json.loads(fp.read())
+            if cached.get('key') == key and cached.get('version'):
+                return cached['version']
+        except (IOError, OSError, ValueError):
+            pass
+
+    version = warm_seed_cache(probe, **template_dict)
+    tmp_file = version_file + '.' + str(os.getpid())
+    with open(tmp_file, 'w') as fp:
+        fp.write(json.dumps({'key': key, 'version': version}))
+    os.replace(tmp_file, version_file)
+    return version
+
+
+def acquire_worker_cache(**template_dict):
+    """Gives the calling worker process its own MCR_CACHE_ROOT, the first free worker-N cache root in cache_dir, seeded
+    from the warm seed the first time it is used
+        Returns:
+            lock_fd (int): lock held on the worker cache until the worker process exits
+    """
+    cache_dir = mcr_cache_dir(**template_dict)
+    seed_dir = os.path.join(cache_dir, 'seed')
+    os.makedirs(cache_dir, exist_ok=True)
+    worker = 0
+    while True:
+        lock_fd = os.open(os.path.join(cache_dir, 'worker-' + str(worker) + '.lock'), os.O_RDWR | os.O_CREAT, 0o666)
+        if fmri_host_slots.try_lock(lock_fd):
+            break
+        os.close(lock_fd)
+        worker = worker + 1
+
+    worker_dir = os.path.join(cache_dir, 'worker-' + str(worker))
+    if not os.path.isfile(os.path.join(worker_dir, SEEDED_MARKER)) and os.path.isfile(
+            os.path.join(seed_dir, SEEDED_MARKER)):
+        # A partial copy left by a crashed worker is replaced
+        shutil.rmtree(worker_dir, ignore_errors=True)
+        start_time = time.time()
+        shutil.copytree(seed_dir, worker_dir, symlinks=True)
+        write_start_time('worker_seed_time', time.time() - start_time, **template_dict)
+    os.makedirs(worker_dir, exist_ok=True)
+    os.environ['MCR_CACHE_ROOT'] = worker_dir
+    return lock_fd
+
+
+def start_time_report(**template_dict):
+    """Returns the cold and warm MCR start times for the output message, empty if none were recorded"""
+    start_times = read_start_times(**template_dict)
+    if 'cold_start_time' not in start_times:
+        return ''
+    report = ' MATLAB runtime start: cold ' + '{:.1f}'.format(start_times['cold_start_time']) + 's'
+    if 'warm_start_time' in start_times:
+        report = report + ', warm ' + '{:.1f}'.format(start_times['warm_start_time']) + 's'
+    return report + '.'
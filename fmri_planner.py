@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This layer plans the pre-processing run before any subject is processed
+The headers of all the inputs are read in parallel to estimate each subject's runtime, peak memory and disk footprint,
+the run fails fast when the outputs can not fit in the output directory and the subjects are ordered
+longest-processing-time-first so that a parallel run does not end with one long subject running alone
+Estimates are calibrated with the timings recorded by earlier runs
+"""
+import os, time, shutil, warnings
+from concurrent.futures import ThreadPoolExecutor
+with warnings.catch_warnings():
+    warnings.filterwarnings("ignore")
+import ujson as json
+import numpy as np
+
+import fmri_dicom_index
+
+# Cost model used until timings from earlier runs are recorded
+SECONDS_PER_SUBJECT = 60.0  # MCR start up, reorient and workflow overhead
+SECONDS_PER_MEGAVOXEL = 0.5  # per million voxels x volumes of input
+MCR_BASELINE_MEMORY = 1.5 * 1024 ** 3  # bytes used by the MATLAB runtime and SPM
+STAGE_MEMORY_FACTOR = 2.5  # SPM holds the series as doubles plus a working copy
+FLOAT_BYTES = 4  # normalized and smoothed images are written as float32
+DISK_MARGIN = 1.1  # keep 10% of headroom when checking free space
+HISTORY_LENGTH = 200  # number of recorded subjects used to calibrate the estimates
+
+
+class SubjectPlan:
+    """Estimates for one input subject, index is the position of the subject in the input data"""
+
+    def __init__(self, index, each_sub, path):
+        self.index = index
+        self.each_sub = each_sub
+        self.path = path
+        self.shape = None
+        self.num_volumes = 1
+        self.itemsize = 2
+        self.compressed = False
+        self.num_files = 1
+        self.scan_label = ''
+        self.series = list()
+        self.converted_file = None
+        self.conversion_error = None
+        self.input_bytes = 0
+        self.megavoxels = 0.0
+        self.runtime = 0.0
+        self.model_peak_memory = 0
+        self.peak_memory = 0
+        self.disk = 0
+        self.error = None
+
+
+def subject_input_path(each_sub, data_type):
+    """Returns the path of the input nifti file or dicom directory of a subject"""
+    if data_type == 'bids':
+        return each_sub.filename
+    return each_sub
+
+
+def read_input_header(subject_plan, data_type):
+    """Reads the dimensions, number of volumes, data type and compression of the input without loading the data.
+    For dicoms the series of the directory are indexed from the headers and every file is assumed to hold one int16
+    slice or volume"""
+    try:
+        if data_type == 'dicoms':
+            subject_plan.series = fmri_dicom_index.index_dicom_dir(subject_plan.path)
+            sizes = [os.path.getsize(file_path) for dicom_series in subject_plan.series for file_path in
+                     dicom_series.files]
+            subject_plan.num_files = len(sizes)
+            subject_plan.input_bytes = sum(sizes)
+            subject_plan.megavoxels = subject_plan.input_bytes / subject_plan.itemsize / 1e6
+        else:
+            import nibabel as nib
+            header = nib.load(subject_plan.path).header
+            subject_plan.shape = tuple(int(dim) for dim in header.get_data_shape())
+            subject_plan.num_volumes = subject_plan.shape[3] if len(subject_plan.shape) > 3 else 1
+            subject_plan.itemsize = np.dtype(header.get_data_dtype()).itemsize
+            subject_plan.compressed = subject_plan.path.endswith('.gz')
+            subject_plan.input_bytes = os.path.getsize(subject_plan.path)
+            subject_plan.megavoxels = float(np.prod(subject_plan.shape)) / 1e6
+    except Exception as e:
+        # The subject is still planned, the error is reported when the subject is processed
+        subject_plan.error = str(e)
+    return subject_plan
+
+
+def normalized_voxels(**template_dict):
+    """Returns the number of voxels of a normalized volume summed over the parameter sweep variants"""
+    bounding_box = np.array(template_dict['options_normalize_write_bounding_box'], dtype=float)
+    voxel_sizes = [variant['options_normalize_write_voxel_sizes'] for variant in
+                   template_dict.get('sweep_variants', list())] or [
+                      template_dict['options_normalize_write_voxel_sizes']]
+    return sum([float(np.prod(np.floor((bounding_box[1] - bounding_box[0]) / np.array(sizes, dtype=float)) + 1))
+                for sizes in voxel_sizes])
+
+
+def estimate_subject(subject_plan, rates, **template_dict):
+    """Estimates the runtime in seconds, peak memory and disk footprint in bytes of a subject"""
+    native_bytes = subject_plan.megavoxels * 1e6 * subject_plan.itemsize
+    subject_plan.runtime = rates['seconds_per_subject'] + rates['seconds_per_megavoxel'] * subject_plan.megavoxels
+    subject_plan.model_peak_memory = int(MCR_BASELINE_MEMORY + STAGE_MEMORY_FACTOR * subject_plan.megavoxels * 1e6 * 8)
+    subject_plan.peak_memory = int(rates['memory_ratio'] * subject_plan.model_peak_memory)
+    # input copy, realigned and slicetime corrected series, normalized and smoothed series of every variant
+    subject_plan.disk = int(3 * native_bytes + 2 * FLOAT_BYTES * subject_plan.num_volumes * normalized_voxels(
+        **template_dict))
+    return subject_plan
+
+
+def history_file(**template_dict):
+    """Returns the path of the json file storing the timings of earlier runs"""
+    return os.path.join(template_dict['cache_dir'], template_dict['planner_history_filename'])
+
+
+def load_history(**template_dict):
+    """Returns the recorded timings of earlier runs"""
+    try:
+        with open(history_file(**template_dict)) as fp:
+            return json.loads(fp.read())
+    except (IOError, OSError, ValueError):
+        return list()
+
+
+def calibrated_rates(history):
+    """Fits the per subject and per megavoxel runtime to the recorded timings and the observed/estimated peak memory
+    ratio to the recorded peaks, falls back to the defaults"""
+    rates = {'seconds_per_subject': SECONDS_PER_SUBJECT, 'seconds_per_megavoxel': SECONDS_PER_MEGAVOXEL}
+    ratios = [entry['peak_memory'] / entry['estimated_peak_memory'] for entry in history if
+              entry.get('peak_memory') and entry.get('estimated_peak_memory')]
+    rates['memory_ratio'] = float(np.median(ratios)) if ratios else 1.0
+    timings = [(entry['megavoxels'], entry['runtime']) for entry in history if entry.get('runtime')]
+    if len(timings) >= 2 and len(set([megavoxels for megavoxels, runtime in timings])) >= 2:
+        slope, intercept = np.polyfit([t[0] for t in timings], [t[1] for t in timings], 1)
+        if slope > 0 and intercept >= 0:
+            rates.update({'seconds_per_subject': float(intercept), 'seconds_per_megavoxel': float(slope)})
+    elif timings:
+        megavoxels, runtime = timings[-1]
+        rates['seconds_per_megavoxel'] = max(runtime - SECONDS_PER_SUBJECT, 0) / max(megavoxels, 1e-6)
+    return rates
+
+
+def record_timing(subject_plan, runtime, peak_memory=None, **template_dict):
+    """Appends the observed runtime and peak memory of a subject to the history used to calibrate later estimates"""
+    try:
+        os.makedirs(template_dict['cache_dir'], exist_ok=True)
+        history = load_history(**template_dict)
+        history.append({
+            'megavoxels': subject_plan.megavoxels,
+            'runtime': runtime,
+            'peak_memory': peak_memory,
+            'estimated_peak_memory': subject_plan.model_peak_memory,
+            'time': time.time()
+        })
+        tmp_file = history_file(**template_dict) + '.' + str(os.getpid())
+        with open(tmp_file, 'w') as fp:
+            fp.write(json.dumps(history[-HISTORY_LENGTH:]))
+        os.replace(tmp_file, history_file(**template_dict))
+    except (IOError, OSError):
+        pass
+
+
+def label_scans(plans):
+    """Sets the scan_label of the BIDS scans sharing their subject and session with other scans, e.g. the task and run
+    entities task-rest_run-1, so that each scan gets its own output and working directories"""
+    scans = dict()
+    for subject_plan in plans:
+        entities = subject_plan.each_sub.entities
+        scans.setdefault((entities['subject'], entities.get('session', '')), list()).append(subject_plan)
+    for subject_plans in scans.values():
+        if len(subject_plans) < 2:
+            continue
+        for subject_plan in subject_plans:
+            parts = os.path.basename(subject_plan.path).split('.')[0].split('_')[:-1]
+            subject_plan.scan_label = '_'.join(
+                [part for part in parts if not part.startswith(('sub-', 'ses-'))]) or str(subject_plan.index + 1)
+        if len(set([subject_plan.scan_label for subject_plan in subject_plans])) < len(subject_plans):
+            for subject_plan in subject_plans:
+                subject_plan.scan_label += '_' + str(subject_plan.index + 1)
+
+
+def plan_subjects(smri_data, data_type, write_dir, **template_dict):
+    """Reads the headers of all the subjects in parallel and returns their plans longest-processing-time-first
+        Args:
+            smri_data (list): input nifti files, BIDS files or dicom directories
+            data_type (string): bids, nifti, dicoms
+            write_dir (string): output directory, checked for free space
+            template_dict ( dictionary) : Dictionary that stores all the paths, file names, software locations
+        Returns:
+            plans (list): SubjectPlan of each subject, longest estimated runtime first
+        Comments:
+            Raises EnvironmentError if the estimated outputs do not fit in write_dir
+    """
+    plans = [
+        SubjectPlan(index, each_sub, subject_input_path(each_sub, data_type))
+        for index, each_sub in enumerate(smri_data)
+    ]
+    with ThreadPoolExecutor(max_workers=template_dict['planner_num_threads']) as executor:
+        plans = list(executor.map(lambda subject_plan: read_input_header(subject_plan, data_type), plans))
+
+    if data_type == 'bids':
+        label_scans(plans)
+
+    rates = calibrated_rates(load_history(**template_dict))
+    for subject_plan in plans:
+        estimate_subject(subject_plan, rates, **template_dict)
+
+    required_disk = sum([subject_plan.disk for subject_plan in plans]) * DISK_MARGIN
+    free_disk = shutil.disk_usage(write_dir).free
+    if required_disk > free_disk:
+        raise EnvironmentError(
+            "Not enough free space in " + str(write_dir) + ": outputs need about " + str(
+                int(required_disk / 1024 ** 2)) + "MB, " + str(int(free_disk / 1024 ** 2)) + "MB available")
+
+    return sorted(plans, key=lambda subject_plan: subject_plan.runtime, reverse=True)
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This layer writes the cohort QC report, one static html page in the output zip with a row per subject
+Each subject gets a mosaic of axial slices of its middle volume, its FD and DVARS traces and a carpet plot (intensity of a
+subset of brain voxels x time). The series is read once as a stream of volume chunks (fmri_image_io) to compute DVARS
+and collect the carpet voxels, and the subjects are rendered in a process pool. Images are written as png without the
+matplotlib stack and traces are inline svg
+"""
+import os, glob, html, multiprocessing, traceback
+
+import numpy as np
+
+import fmri_display
+import fmri_image_io
+import fmri_subject_layer
+
+MOSAIC_SLICES = 12  # axial slices in a mosaic
+TRACE_WIDTH = 600
+TRACE_HEIGHT = 60
+
+
+def brain_mask(volume):
+    """Returns the voxels of a volume brighter than 20% of its 98th percentile"""
+    volume = np.nan_to_num(np.asarray(volume, dtype=np.float32))
+    positive = volume[volume > 0]
+    if not positive.size:
+        return np.ones(volume.shape, dtype=bool)
+    return volume > 0.2 * np.percentile(positive, 98)
+
+
+def scale_to_uint8(image):
+    image = np.nan_to_num(np.asarray(image, dtype=np.float32))
+    low, high = np.percentile(image, [2, 98])
+    return np.clip((image - low) * 255.0 / max(high - low, 1e-6), 0, 255).astype(np.uint8)
+
+
+def mosaic_png(volume):
+    """Returns the png of MOSAIC_SLICES axial slices of a volume, in rows of 6"""
+    slices = [np.flipud(volume[:, :, z].T) for z in
+              np.linspace(0, volume.shape[2] - 1, MOSAIC_SLICES + 2).astype(int)[1:-1]]
+    rows = [np.hstack(slices[i:i + 6]) for i in range(0, len(slices), 6)]
+    return fmri_display.png_bytes(scale_to_uint8(np.vstack(rows)))
+
+
+def carpet_png(carpet):
+    """Returns the png of a voxels x time carpet, each voxel's time series z-scored"""
+    carpet = carpet - carpet.mean(axis=1, keepdims=True)
+    carpet = carpet / np.maximum(carpet.std(axis=1, keepdims=True), 1e-6)
+    return fmri_display.png_bytes(np.clip((carpet + 2.0) * 255.0 / 4.0, 0, 255))
+
+
+def trace_svg(values, label, threshold=None):
+    """Returns an inline svg line plot of a trace"""
+    values = np.nan_to_num(np.asarray(values, dtype=float))
+    if not values.size:
+        return ''
+    top = max(float(values.max()), threshold or 0.0, 1e-6)
+    x = np.linspace(0, TRACE_WIDTH, max(len(values), 2))
+    y = TRACE_HEIGHT - values / top * (TRACE_HEIGHT - 2)
+    points = ' '.join(['%.1f,%.1f' % point for point in zip(x, y)])
+    threshold_line = ''
+    if threshold is not None:
+        threshold_y = TRACE_HEIGHT - threshold / top * (TRACE_HEIGHT - 2)
+        threshold_line = '<line x1="0" x2="%d" y1="%.1f" y2="%.1f" stroke="red" stroke-dasharray="4"/>' % (
+            TRACE_WIDTH, threshold_y, threshold_y)
+    return ('<svg width="%d" height="%d"><polyline fill="none" stroke="black" points="%s"/>%s'
+            '<text x="4" y="12" font-size="11">%s max %.2f</text></svg>') % (
+        TRACE_WIDTH, TRACE_HEIGHT, points, threshold_line, html.escape(label), values.max())
+
+
+def render_subject(subject):
+    """Renders the QC images of one subject into report_dir, returns its row of the report
+        Args:
+            subject (tuple): label, fmri_out, report_dir and template_dict of the subject
+    """
+    label, fmri_out, report_dir, template_dict = subject
+    row = {'label': label}
+    try:
+        output_dir = os.path.join(fmri_out, fmri_subject_layer.output_dirnames(**template_dict)[0])
+        rp_files = glob.glob(os.path.join(fmri_out, template_dict['fmri_output_dirname'], 'rp*.txt'))
+        if rp_files:
+            row['FD'] = fmri_subject_layer.framewise_displacement(np.loadtxt(rp_files[0]))
+
+        # The series is compressed when output_compression is set
+        series_files = glob.glob(os.path.join(output_dir, template_dict['qc_nifti'])) + glob.glob(
+            os.path.join(output_dir, template_dict['qc_nifti'] + '.gz'))
+        series = fmri_image_io.Volume4D(series_files[0],
+                                        os.path.join(template_dict['cache_dir'], template_dict['gzip_index_dirname']))
+        middle = np.asarray(series.volume(int(series.num_volumes / 2)), dtype=np.float32)
+        mask = brain_mask(middle)
+        voxels = np.flatnonzero(mask.ravel(order='F'))
+        voxels = voxels[np.linspace(0, len(voxels) - 1, min(template_dict['qc_report_carpet_voxels'], len(voxels))).astype(int)]
+
+        # One pass over the series for DVARS and the carpet voxels
+        dvars = list()
+        carpet = list()
+        previous = None
+        for start, volumes in series.iter_volumes():
+            volumes = np.asarray(volumes, dtype=np.float32)
+            flat = volumes.reshape((-1, volumes.shape[3]), order='F')
+            carpet.append(flat[voxels])
+            masked = flat[mask.ravel(order='F')]
+            if previous is not None:
+                masked = np.hstack([previous, masked])
+            dvars.extend(np.sqrt(np.mean(np.diff(masked, axis=1) ** 2, axis=0)))
+            previous = masked[:, -1:]
+        row['DVARS'] = np.array(dvars)
+
+        with open(os.path.join(report_dir, label + '_mosaic.png'), 'wb') as fp:
+            fp.write(mosaic_png(middle))
+        with open(os.path.join(report_dir, label + '_carpet.png'), 'wb') as fp:
+            fp.write(carpet_png(np.hstack(carpet)))
+    except Exception as e:
+        row['error'] = str(e) + str(traceback.format_exc())
+    return row
+
+
+def report_row(row, **template_dict):
+    cells = ['<td>' + html.escape(row['label']) + '</td>']
+    if 'FD' in row:
+        cells.append('<td>%.3f</td>' % float(np.mean(row['FD'])))
+    else:
+        cells.append('<td></td>')
+    if 'error' in row:
+        cells.append('<td colspan="2"><pre>' + html.escape(row['error']) + '</pre></td>')
+    else:
+        cells.append('<td><img src="%s_mosaic.png"/></td>' % html.escape(row['label']))
+        cells.append('<td>' + trace_svg(row.get('FD', []), 'FD (mm)', template_dict['FD_rms_mean_threshold']) +
+                     '<br/>' + trace_svg(row['DVARS'], 'DVARS') +
+                     '<br/><img src="%s_carpet.png" width="%d" height="150"/></td>' % (
+                         html.escape(row['label']), TRACE_WIDTH))
+    return '<tr>' + ''.join(cells) + '</tr>'
+
+
+def write_qc_report(subjects, write_dir, **template_dict):
+    """Renders the QC report of the successful subjects into write_dir/qc_report_dirname
+        Args:
+            subjects (list): (label, fmri_out) of each successful subject
+            write_dir (string): directory zipped as the output of the run
+            template_dict ( dictionary) : Dictionary that stores all the paths, file names, software locations
+        Returns:
+            report_file (string): the html page
+    """
+    report_dir = os.path.join(write_dir, template_dict['qc_report_dirname'])
+    os.makedirs(report_dir, exist_ok=True)
+    num_workers = int(template_dict['qc_report_num_workers']) or os.cpu_count() or 1
+    tasks = [(label, fmri_out, report_dir, template_dict) for label, fmri_out in sorted(subjects)]
+    # The output archive's threads are running, the workers are forked by a forkserver instead of this process
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload([__name__])
+    pool = context.Pool(max(1, min(num_workers, len(tasks) or 1)))
+    try:
+        rows = pool.map(render_subject, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    report_file = os.path.join(report_dir, 'qc_report.html')
+    with open(report_file, 'w') as fp:
+        fp.write('<!DOCTYPE html><html><head><meta charset="utf-8"><title>fMRI QC report</title>'
+                 '<style>body{font-family:sans-serif} td{vertical-align:top;padding:4px;border-bottom:1px solid #ccc}'
+                 'img{image-rendering:pixelated}</style></head><body><h1>fMRI pre-processing QC report</h1>'
+                 '<p>' + str(len(rows)) + ' subjects, FD threshold ' + str(
+                     template_dict['FD_rms_mean_threshold']) + ' mm</p><table><tr><th>Subject</th><th>Mean FD</th>'
+                 '<th>Mosaic</th><th>FD, DVARS and carpet plot</th></tr>')
+        fp.write(''.join([report_row(row, **template_dict) for row in rows]))
+        fp.write('</table></body></html>')
+    return report_file
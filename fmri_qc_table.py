@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This layer keeps the cohort QC table, one row per subject with its motion measures, QA status and runtime
+Subject workers append their row as they finish. The row is written to a csv file for people and as a fixed-size record
+to a binary file that loads in one read, both under an exclusive lock and with single O_APPEND writes, so that
+concurrent workers never interleave or overwrite each other's rows. The QA summary of the run is computed from the table
+"""
+import os, fcntl
+
+import numpy as np
+
+CSV_EXTENSION = '.csv'
+RECORD_EXTENSION = '.bin'
+
+# Fields of a row, the record of the binary file has the same layout
+RECORD_DTYPE = np.dtype([
+    ('index', '<i4'),
+    ('sub_id', 'S64'),
+    ('session', 'S32'),
+    ('status', 'S8'),
+    ('FD_rms_mean', '<f4'),
+    ('FD_max', '<f4'),
+    ('FD_spikes', '<i4'),
+    ('num_volumes', '<i4'),
+    ('runtime', '<f4'),
+])
+
+PASSED = 'passed'
+FLAGGED = 'flagged'
+FAILED = 'failed'
+
+
+def table_files(write_dir, **template_dict):
+    """Returns the csv and binary files of the table in write_dir"""
+    table_file = os.path.join(write_dir, template_dict['qc_table_filename'])
+    return table_file + CSV_EXTENSION, table_file + RECORD_EXTENSION
+
+
+def reset_table(write_dir, **template_dict):
+    """Removes the table of an earlier run in write_dir and the flagged subjects file written from it"""
+    for table_file in list(table_files(write_dir, **template_dict)) + [
+            os.path.join(write_dir, template_dict['qa_flagged_filename'])]:
+        if os.path.isfile(table_file):
+            os.remove(table_file)
+
+
+def subject_status(result, **template_dict):
+    """Returns the QA status of a subject from its result dict"""
+    if result['error']:
+        return FAILED
+    if result['FD_rms_mean'] is not None and round(result['FD_rms_mean'], 2) > template_dict['FD_rms_mean_threshold']:
+        return FLAGGED
+    return PASSED
+
+
+def append_row(write_dir, result, runtime, **template_dict):
+    """Appends the row of one subject to the table
+        Args:
+            write_dir (string): directory of the table
+            result (dict): result of fmri_subject_layer.process_subject
+            runtime (float): processing time of the subject in seconds
+            template_dict ( dictionary) : Dictionary that stores all the paths, file names, software locations
+    """
+    record = np.zeros(1, dtype=RECORD_DTYPE)
+    record['index'] = result['index']
+    record['sub_id'] = result['sub_id'].encode('utf-8')
+    record['session'] = result['session'].encode('utf-8')
+    record['status'] = subject_status(result, **template_dict).encode('utf-8')
+    for field in ('FD_rms_mean', 'FD_max'):
+        record[field] = np.nan if result.get(field) is None else result[field]
+    record['FD_spikes'] = result.get('FD_spikes') or 0
+    record['num_volumes'] = result.get('num_volumes') or 0
+    record['runtime'] = runtime
+
+    csv_file, record_file = table_files(write_dir, **template_dict)
+    line = ','.join([str(record[field][0].decode('utf-8') if RECORD_DTYPE[field].kind == 'S' else record[field][0])
+                     for field in RECORD_DTYPE.names]) + '\n'
+    csv_fd = os.open(csv_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        # The lock on the csv file covers both files
+        fcntl.flock(csv_fd, fcntl.LOCK_EX)
+        if os.fstat(csv_fd).st_size == 0:
+            line = ','.join(RECORD_DTYPE.names) + '\n' + line
+        os.write(csv_fd, line.encode('utf-8'))
+        record_fd = os.open(record_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(record_fd, record.tobytes())
+        finally:
+            os.close(record_fd)
+    finally:
+        fcntl.flock(csv_fd, fcntl.LOCK_UN)
+        os.close(csv_fd)
+
+
+def read_table(write_dir, **template_dict):
+    """Returns the table as a numpy record array ordered by subject index, the last row of a subject written more than
+    once wins"""
+    record_file = table_files(write_dir, **template_dict)[1]
+    if not os.path.isfile(record_file):
+        return np.zeros(0, dtype=RECORD_DTYPE)
+    table = np.fromfile(record_file, dtype=RECORD_DTYPE)
+    last_rows = {index: row for row, index in enumerate(table['index'])}
+    return table[sorted(last_rows.values(), key=lambda row: table['index'][row])]
+
+
+def flagged_subjects(table):
+    """Returns the sub-id and session of the subjects flagged by QA"""
+    return [(row['sub_id'].decode('utf-8'), row['session'].decode('utf-8')) for row in table if
+            row['status'].decode('utf-8') == FLAGGED]
+
+
+def qa_percentage(table, num_subjects):
+    """Returns the percentage of the input subjects that were pre-processed and passed QA"""
+    return 100.0 * np.count_nonzero(table['status'] == PASSED.encode('utf-8')) / max(num_subjects, 1)
+
+
+def write_flagged_file(table, write_dir, **template_dict):
+    """Writes the sub-ids of the flagged subjects to qa_flagged_filename, one per line, returns their number"""
+    flagged = flagged_subjects(table)
+    flagged_file = os.path.join(write_dir, template_dict['qa_flagged_filename'])
+    if flagged:
+        with open(flagged_file + '.tmp', 'w') as fp:
+            fp.write(''.join([sub_id + session + '\n' for sub_id, session in flagged]))
+        os.replace(flagged_file + '.tmp', flagged_file)
+    return len(flagged)
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This layer runs subjects concurrently, each subject in its own process
+An admission controller reads the cpu and memory limits of the container's cgroup and only starts a subject when its
+estimated peak memory fits the remaining budget, observed peaks are fed back into the estimates of the next subjects
+"""
+import os, math, time, resource, traceback
+import multiprocessing
+from queue import Empty
+
+import numpy as np
+
+import fmri_mcr_cache
+import fmri_thread_budget
+
+MEMORY_SAFETY_FACTOR = 1.2  # applied to the observed/estimated peak memory ratio
+POLL_INTERVAL = 1.0  # seconds between checks for crashed workers
+
+
+def read_cgroup_file(*paths):
+    """Returns the stripped content of the first readable file among paths, None if none can be read"""
+    for path in paths:
+        try:
+            with open(path) as fp:
+                return fp.read().strip()
+        except (IOError, OSError):
+            continue
+    return None
+
+
+def read_cgroup_limits():
+    """Returns the number of cpus and the memory in bytes available to the container
+    cgroup v2 (cpu.max, memory.max) and cgroup v1 (cpu.cfs_quota_us, memory.limit_in_bytes) limits are read,
+    the host's cpus and physical memory are used when no limit is set
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+    memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+    cpu_max = read_cgroup_file('/sys/fs/cgroup/cpu.max')
+    if cpu_max and cpu_max.split()[0] != 'max':
+        quota, period = cpu_max.split()[:2]
+        cpus = min(cpus, max(1, int(math.ceil(float(quota) / float(period)))))
+    else:
+        quota = read_cgroup_file('/sys/fs/cgroup/cpu/cpu.cfs_quota_us', '/sys/fs/cgroup/cpu,cpuacct/cpu.cfs_quota_us')
+        period = read_cgroup_file('/sys/fs/cgroup/cpu/cpu.cfs_period_us',
+                                  '/sys/fs/cgroup/cpu,cpuacct/cpu.cfs_period_us')
+        if quota and period and int(quota) > 0:
+            cpus = min(cpus, max(1, int(math.ceil(float(quota) / float(period)))))
+
+    memory_max = read_cgroup_file('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes')
+    if memory_max and memory_max != 'max':
+        # cgroup v1 reports a huge number when there is no limit
+        memory = min(memory, int(memory_max))
+
+    return cpus, memory
+
+
+class AdmissionController:
+    """Admits subjects while the sum of their estimated peak memory fits memory_budget"""
+
+    def __init__(self, memory_budget):
+        self.memory_budget = memory_budget
+        self.admitted = dict()
+        self.ratios = list()
+
+    def correction(self):
+        """Observed/estimated peak memory ratio of the finished subjects, 1 until a subject has finished"""
+        if not self.ratios:
+            return 1.0
+        return MEMORY_SAFETY_FACTOR * float(np.mean(self.ratios))
+
+    def estimate(self, subject_plan):
+        return int(subject_plan.peak_memory * self.correction())
+
+    def available(self):
+        return self.memory_budget - sum(self.admitted.values())
+
+    def try_admit(self, subject_plan):
+        """Admits the subject if its estimated peak fits the remaining budget, a subject is always admitted when
+        nothing else is running so that a subject larger than the budget still runs, alone"""
+        estimate = self.estimate(subject_plan)
+        if self.admitted and estimate > self.available():
+            return False
+        self.admitted[subject_plan.index] = estimate
+        return True
+
+    def release(self, subject_plan, peak_memory=None):
+        """Frees the budget of a finished subject and feeds its observed peak memory back into the estimates"""
+        self.admitted.pop(subject_plan.index, None)
+        if peak_memory and subject_plan.peak_memory:
+            self.ratios.append(float(peak_memory) / subject_plan.peak_memory)
+
+
+def max_workers(num_subjects, cpus, **template_dict):
+    """Returns the number of subjects to run at once, num_workers=0 uses one worker per available cpu"""
+    num_workers = int(template_dict['num_workers']) or cpus
+    return max(1, min(num_workers, num_subjects))
+
+
+def subject_worker(results, target, subject_plan, args, cpu_share, template_dict):
+    """Runs target on one subject in a worker process limited to the cores of the shared array cpu_share and using its
+    own MCR cache root, puts the result with its runtime and peak memory on results"""
+    start_time = time.time()
+    try:
+        num_threads = fmri_thread_budget.start_worker(cpu_share, template_dict['pin_workers'])
+        # The lock on the worker's MCR cache root is released when the worker process exits
+        fmri_mcr_cache.acquire_worker_cache(**template_dict)
+        result = target(subject_plan, *args, **dict(template_dict, spm_num_threads=num_threads))
+    except Exception as e:
+        result = {'index': subject_plan.index, 'error': str(e) + str(traceback.format_exc())}
+    # ru_maxrss is in kilobytes, the children include the MATLAB runtime processes started by SPM
+    result['peak_memory'] = 1024 * max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    result['runtime'] = time.time() - start_time
+    results.put(result)
+
+
+def run_subjects(subject_plans, target, args=(), input_stage=None, **template_dict):
+    """Runs target(subject_plan, *args, **template_dict) on every subject and yields (subject_plan, result) as each
+    subject finishes
+        Args:
+            subject_plans (list): SubjectPlan of each subject from fmri_planner, started in this order
+            target (function): module level function processing one subject, returns a picklable result dict
+            args (tuple): picklable arguments passed to target after subject_plan
+            input_stage (object): optional stage preparing the inputs ahead of the processing, e.g.
+                                  fmri_conversion.ConversionPool, a subject is only started once input_stage.ready
+                                  returns True for it and input_stage.started is called when it starts
+            template_dict ( dictionary) : Dictionary that stores all the paths, file names, software locations
+        Comments:
+            Each subject runs in a process with its share of the cores from fmri_thread_budget, passed to target as
+            template_dict['spm_num_threads']. The processes are forked by a forkserver rather than by this process,
+            whose input stage and output archive threads would be copied into them in an unknown state. A subject
+            whose process dies (e.g. killed for running out of memory) is yielded with an error. The next pending
+            subject whose estimated peak fits the remaining memory budget is started whenever a worker is free
+    """
+    cpus, memory = read_cgroup_limits()
+    workers = max_workers(len(subject_plans), cpus, **template_dict)
+    admission = AdmissionController(memory - template_dict['memory_reserve_mb'] * 1024 ** 2)
+    thread_budget = fmri_thread_budget.ThreadBudget(cpus, template_dict['pin_workers'])
+
+    # The forkserver imports the target's module once, the workers forked from it start with it loaded
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload([target.__module__])
+    results = context.Queue()
+    pending = list(subject_plans)
+    running = dict()
+    cpu_shares = dict()
+
+    while pending or running:
+        # Start the first pending subjects that fit the memory budget
+        for subject_plan in list(pending):
+            if len(running) >= workers:
+                break
+            if input_stage is not None and not input_stage.ready(subject_plan):
+                continue
+            if admission.try_admit(subject_plan):
+                pending.remove(subject_plan)
+                # Share the free cores between the workers that can still be started
+                cpu_ids = thread_budget.acquire(subject_plan.index, min(workers, len(running) + len(pending) + 1) - len(
+                    running))
+                cpu_shares[subject_plan.index] = fmri_thread_budget.shared_cpu_ids(context, cpu_ids,
+                                                                                   len(thread_budget.cpu_ids))
+                process = context.Process(
+                    target=subject_worker,
+                    args=(results, target, subject_plan, args, cpu_shares[subject_plan.index], template_dict))
+                process.start()
+                running[subject_plan.index] = (subject_plan, process)
+                if input_stage is not None:
+                    input_stage.started(subject_plan)
+
+        # No subject left to start, the cores of the finished workers widen the running ones
+        if not pending:
+            for index, cpu_ids in thread_budget.rebalance().items():
+                fmri_thread_budget.write_cpu_ids(cpu_shares[index], cpu_ids)
+
+        finished = list()
+        try:
+            finished.append(results.get(timeout=POLL_INTERVAL))
+            while True:
+                finished.append(results.get_nowait())
+        except Empty:
+            pass
+
+        for result in finished:
+            subject_plan, process = running.pop(result['index'])
+            process.join()
+            admission.release(subject_plan, result.get('peak_memory'))
+            thread_budget.release(subject_plan.index)
+            yield subject_plan, result
+
+        # Workers that died without putting a result
+        if not finished:
+            for index, (subject_plan, process) in list(running.items()):
+                if not process.is_alive():
+                    try:
+                        # The result may have been queued just before the process exited
+                        result = results.get(timeout=POLL_INTERVAL)
+                    except Empty:
+                        result = None
+                    if result is not None:
+                        finished_plan, finished_process = running.pop(result['index'])
+                        finished_process.join()
+                        admission.release(finished_plan, result.get('peak_memory'))
+                        thread_budget.release(finished_plan.index)
+                        yield finished_plan, result
+                        break
+                    running.pop(index)
+                    admission.release(subject_plan)
+                    thread_budget.release(subject_plan.index)
+                    yield subject_plan, {
+                        'index': subject_plan.index,
+                        'error': 'Worker process exited with code ' + str(process.exitcode) +
+                                 ', it may have run out of memory'
+                    }
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This layer places the nipype working directory of a subject, the intermediate images of every stage, on a scratch
+directory (tmpfs or local SSD) when scratch_dir is set and the subject fits in the scratch budget
+Each subject reserves its estimated intermediate size against scratch_budget_mb before it starts. The reservations are
+files in scratch_dir held with flock by the workers, so the reservations of crashed workers are dropped by the next
+subject scanning the directory. A subject that does not fit spills to the working directory on disk. Only the outputs
+collected by the datasink are written to the output directory
+"""
+import os, socket, fcntl
+
+import fmri_host_slots
+
+# Intermediate copies of the series a subject writes, as float32: realigned, slice-timed, normalized, smoothed and the
+# copies nipype keeps of the node inputs
+INTERMEDIATE_COPIES = 6
+
+
+def estimated_scratch_bytes(image):
+    """Returns the estimated size of the intermediate files of a subject, from the header of its input image"""
+    num_voxels = 1
+    for dim in image.header.get_data_shape():
+        num_voxels *= int(dim)
+    return INTERMEDIATE_COPIES * 4 * num_voxels
+
+
+class ScratchReservation:
+    """Reservation of scratch space for the working directory of one subject
+        Args:
+            scratch_dir (string): scratch directory, None to always use the working directory on disk
+            budget_mb (int): scratch space shared by all the subjects of the host
+            num_bytes (int): space reserved
+        e.g.:
+            reservation = ScratchReservation(template_dict['scratch_dir'], template_dict['scratch_budget_mb'], size)
+            work_dir = reservation.work_dir(os.getcwd(), sub_id + session)
+            ...
+            reservation.release()
+    """
+
+    def __init__(self, scratch_dir, budget_mb, num_bytes):
+        self.scratch_dir = scratch_dir
+        self.fd = None
+        if scratch_dir is None:
+            return
+        reservation_dir = os.path.join(scratch_dir, 'reservations')
+        os.makedirs(reservation_dir, exist_ok=True)
+        statvfs = os.statvfs(scratch_dir)
+        budget = min(int(budget_mb) * 1024 ** 2, statvfs.f_bavail * statvfs.f_frsize)
+
+        # Reservations are checked and made under the lock of the directory, so two subjects can not take the same space
+        with open(os.path.join(scratch_dir, '.budget.lock'), 'w') as lock_fp:
+            fcntl.flock(lock_fp.fileno(), fcntl.LOCK_EX)
+            reserved = 0
+            for reservation in os.listdir(reservation_dir):
+                reservation_file = os.path.join(reservation_dir, reservation)
+                try:
+                    fd = os.open(reservation_file, os.O_RDWR)
+                except OSError:
+                    continue
+                try:
+                    if fmri_host_slots.try_lock(fd):
+                        # The worker holding it is gone, its working directory too
+                        if os.path.exists(reservation_file):
+                            os.remove(reservation_file)
+                    else:
+                        reserved += fmri_host_slots.read_lock_file(fd).get('bytes', 0)
+                finally:
+                    os.close(fd)
+            if reserved + num_bytes <= budget:
+                self.fd = os.open(os.path.join(reservation_dir, socket.gethostname() + '-' + str(os.getpid())),
+                                  os.O_RDWR | os.O_CREAT, 0o644)
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+                fmri_host_slots.write_lock_file(self.fd, {'bytes': num_bytes})
+
+    @property
+    def on_scratch(self):
+        return self.fd is not None
+
+    def work_dir(self, default_dir, name):
+        """Returns the working directory of the subject, on scratch when the reservation was granted"""
+        if self.on_scratch:
+            return os.path.join(self.scratch_dir, 'fmri_preprocess', name + '-' + str(os.getpid()))
+        return os.path.join(default_dir, 'fmri_preprocess', name)
+
+    def release(self):
+        if self.fd is not None:
+            os.remove(os.path.join(self.scratch_dir, 'reservations', socket.gethostname() + '-' + str(os.getpid())))
+            os.close(self.fd)
+            self.fd = None
+
+
+def stage_time_report(stage_times, num_on_scratch):
+    """Returns the sentence of the output message on the mean wall time of each stage
+        Args:
+            stage_times (list): stage_times dict of each subject, seconds per nipype node or python-side stage
+            num_on_scratch (int): subjects whose working directory was on scratch
+    """
+    if not stage_times:
+        return ''
+    totals = dict()
+    for subject_times in stage_times:
+        for stage, seconds in subject_times.items():
+            totals.setdefault(stage, list()).append(seconds)
+    return " Mean stage wall times (s): " + ", ".join(
+        ["%s %.1f" % (stage, sum(times) / len(times)) for stage, times in sorted(totals.items())]) + ". %d/%d " % (
+        num_on_scratch, len(stage_times)) + "subjects ran with their working directory on scratch."
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This layer runs run_fmri.py as a long-lived server accepting jobs over a Unix socket, and the thin client forwarding a job
+to it
+The server process keeps its imports loaded and the SPM version checked, every job is run in a process forked from it so
+that a job starts warm and can not leak its options into the next one. The client sends the same json that run_fmri.py
+reads on stdin and writes back the same json output, so the coinstac command contract is unchanged
+"""
+import os, sys, io, socket, socketserver, traceback
+
+BUFFER_SIZE = 65536
+
+
+def read_all(connection):
+    chunks = list()
+    while True:
+        chunk = connection.recv(BUFFER_SIZE)
+        if not chunk:
+            return b''.join(chunks)
+        chunks.append(chunk)
+
+
+class JobServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    """Forks a process per job, at most max_children jobs run at once and the next connections wait in the listen
+    backlog (max_children=1 queues the jobs)"""
+
+    def __init__(self, socket_path, run_job, max_jobs=1):
+        self.run_job = run_job
+        self.max_children = max(1, int(max_jobs))
+        socketserver.UnixStreamServer.__init__(self, socket_path, JobHandler)
+
+
+class JobHandler(socketserver.BaseRequestHandler):
+    """Runs one job in the forked process, the output run_job writes to stdout is sent back to the client"""
+
+    def handle(self):
+        input_json = read_all(self.request).decode('utf-8')
+        stdout = sys.stdout
+        sys.stdout = io.StringIO()
+        try:
+            self.server.run_job(input_json)
+        except SystemExit:
+            # args_parser exits after writing a validation error
+            pass
+        except Exception as e:
+            sys.stderr.write('Job failed. Error_log:' + str(e) + str(traceback.format_exc()))
+        finally:
+            output = sys.stdout.getvalue()
+            sys.stdout = stdout
+        self.request.sendall(output.encode('utf-8'))
+
+
+def serve(socket_path, run_job, max_jobs=1):
+    """Accepts jobs on the Unix socket socket_path until the process is stopped
+        Args:
+            socket_path (string): path of the Unix socket, a stale socket file is replaced. Only the user running the
+                                  server may connect, a job runs with the server's privileges
+            run_job (function): runs one job from its input json string, writing the output json to stdout
+            max_jobs (int): number of jobs run in parallel
+    """
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    os.makedirs(os.path.dirname(os.path.abspath(socket_path)), exist_ok=True)
+    # The socket is created owner-only, there is no moment when other users can connect
+    umask = os.umask(0o077)
+    try:
+        server = JobServer(socket_path, run_job, max_jobs)
+    finally:
+        os.umask(umask)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+def submit(socket_path, input_json):
+    """Sends a job to the server and returns its output json, None if no server listens on socket_path"""
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            connection.connect(socket_path)
+        except (IOError, OSError):
+            return None
+        connection.sendall(input_json.encode('utf-8'))
+        connection.shutdown(socket.SHUT_WR)
+        return read_all(connection).decode('utf-8')
+    finally:
+        connection.close()
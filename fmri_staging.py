@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This layer stages the input image of a subject as the uncompressed .nii the pipeline works on, without decoding it
+An uncompressed input is reflinked (copy-on-write clone) where the file system supports it and copied by the kernel
+otherwise, a compressed input is decompressed straight to the target in blocks, so staging uses the same memory
+whatever the length of the series. The header fields the pipeline reads (zooms, shape) come from a header-only load
+Staged files are never hardlinked to the input, the reorientation step rewrites the staged file's header in place
+"""
+import os, shutil, gzip, fcntl
+
+BLOCK_SIZE = 16 * 1024 ** 2  # bytes decompressed at a time
+FICLONE = 0x40049409  # Linux ioctl cloning a file on btrfs, xfs and other reflink-capable file systems
+
+
+def reflink(src, dst):
+    """Clones src to dst sharing its blocks until either is written, returns False if the file system can not"""
+    try:
+        with open(src, 'rb') as src_fp, open(dst, 'wb') as dst_fp:
+            fcntl.ioctl(dst_fp.fileno(), FICLONE, src_fp.fileno())
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def stage_input(src, dst):
+    """Writes the image src as the uncompressed nifti dst
+        Args:
+            src (string): input .nii or .nii.gz file
+            dst (string): staged .nii file
+        Returns:
+            dst (string): the staged file
+        Comments:
+            The file is staged under a temporary name and renamed, an interrupted staging never leaves a partial dst
+    """
+    if os.path.abspath(src) == os.path.abspath(dst):
+        return dst
+    tmp_file = dst + '.staging'
+    try:
+        if src.endswith('.gz'):
+            with gzip.open(src, 'rb') as src_fp, open(tmp_file, 'wb') as dst_fp:
+                shutil.copyfileobj(src_fp, dst_fp, BLOCK_SIZE)
+        elif not reflink(src, tmp_file):
+            shutil.copyfile(src, tmp_file)
+        os.replace(tmp_file, dst)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    return dst
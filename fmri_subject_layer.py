@@ -0,0 +1,542 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This layer runs the pre-processing fmri pipeline on a single subject, it is shared by fmri_use_cases_layer and
+fmri_standalone_use_cases_layer
+Every subject builds its own nodes and workflow from entities layer, so subjects can run concurrently in separate processes
+"""
+import contextlib
+
+
+@contextlib.contextmanager
+def stdchannel_redirected(stdchannel, dest_filename):
+    """
+    A context manager to temporarily redirect stdout or stderr
+    e.g.:
+    with stdchannel_redirected(sys.stderr, os.devnull):
+        if compiler.has_function('clock_gettime', libraries=['rt']):
+            libraries.append('rt')
+    """
+
+    try:
+        oldstdchannel = os.dup(stdchannel.fileno())
+        dest_file = open(dest_filename, 'w')
+        os.dup2(dest_file.fileno(), stdchannel.fileno())
+
+        yield
+    finally:
+        if oldstdchannel is not None:
+            os.dup2(oldstdchannel, stdchannel.fileno())
+        if dest_file is not None:
+            dest_file.close()
+
+
+import sys, os, glob, shutil, warnings, traceback, time
+with warnings.catch_warnings():
+    warnings.filterwarnings("ignore")
+
+import nibabel as nib
+import nipype.pipeline.engine as pe
+import numpy as np
+
+import fmri_compression
+import fmri_conversion_cache
+import fmri_datatype
+import fmri_dicom_index
+import fmri_display
+import fmri_entities_layer
+import fmri_host_slots
+import fmri_qc_table
+import fmri_scratch
+import fmri_staging
+import fmri_thread_budget
+
+#Stop printing nipype.workflow info to stdout
+from nipype import logging
+logging.getLogger('nipype.workflow').setLevel('CRITICAL')
+
+
+def subject_ids(subject_plan, data_type):
+    """Returns the sub-id and session of a subject, sub-ids of nifti files and dicoms follow the order of the input data"""
+    if data_type == 'bids':
+        if 'session' in subject_plan.each_sub.entities:
+            session = subject_plan.each_sub.entities['session']
+        else:
+            session = ''
+        return 'sub-' + subject_plan.each_sub.entities['subject'], session
+    return 'subID-' + str(subject_plan.index + 1), ''
+
+
+def subject_label(subject_plan, data_type):
+    """Returns the label naming the files and working directory of a subject, its sub-id and session followed by the
+    scan label of the planner when the subject has several scans in the session"""
+    sub_id, session = subject_ids(subject_plan, data_type)
+    if subject_plan.scan_label:
+        return sub_id + session + '_' + subject_plan.scan_label
+    return sub_id + session
+
+
+def subject_output_dir(subject_plan, write_dir, data_type):
+    """Returns the directory in which the fmri outputs of a subject are written, a subject with several scans in a
+    session has a directory per scan under func"""
+    sub_id, session = subject_ids(subject_plan, data_type)
+    if subject_plan.scan_label:
+        return os.path.join(write_dir, sub_id, session, 'func', subject_plan.scan_label)
+    return os.path.join(write_dir, sub_id, session, 'func')
+
+
+def convert_dicoms(subject_plan, fmri_out, **template_dict):
+    """Converts the dicom directory of a subject into fmri_out with dcm2niix and returns the converted nifti file
+    A directory mixing several series is rejected before the conversion, from the series index of the planner. A series
+    converted by an earlier run is linked from fmri_conversion_cache instead of being converted again
+    """
+    key = None
+    if subject_plan.error is None:
+        fmri_dicom_index.check_single_series(subject_plan.path, subject_plan.series)
+        key = fmri_conversion_cache.series_key(subject_plan.series[0])
+    os.makedirs(fmri_out, exist_ok=True)
+
+    if key is None or not fmri_conversion_cache.lookup(key, fmri_out, **template_dict):
+        existing_files = set(os.listdir(fmri_out))
+        ## This code runs the dicom to nifti conversion here
+        from nipype.interfaces.dcm2nii import Dcm2niix
+        dcm_nii_convert = Dcm2niix()
+        # Keep dcm2niix's output off the terminal, conversions may run in threads of the main process
+        dcm_nii_convert.terminal_output = 'allatonce'
+        dcm_nii_convert.inputs.source_dir = subject_plan.path
+        dcm_nii_convert.inputs.output_dir = fmri_out
+        dcm_nii_convert.run()
+        if key is not None:
+            fmri_conversion_cache.store(key, [os.path.join(fmri_out, file_name) for file_name in
+                                              set(os.listdir(fmri_out)) - existing_files], **template_dict)
+    return glob.glob(os.path.join(fmri_out, '*.nii*'))[0]
+
+
+def process_subject(subject_plan, write_dir, data_type=None, **template_dict):
+    """Runs the pre-processing pipeline on one subject
+        Args:
+            subject_plan (SubjectPlan): subject to process, from fmri_planner
+            write_dir (string): Directory to write outputs, the subject's outputs go to write_dir/sub_id/session/func
+            data_type (string): BIDS, niftis, dicoms
+            template_dict ( dictionary) : Dictionary that stores all the paths, file names, software locations
+        Returns:
+            result (dict): index, sub_id, session, label, fmri_out, FD_rms_mean, FD_max, FD_spikes and error log of the subject
+        Comments:
+            Errors are returned in the result instead of being raised so that one subject does not stop the others
+    """
+    start_time = time.time()
+    sub_id, session = subject_ids(subject_plan, data_type)
+    label = subject_label(subject_plan, data_type)
+
+    # The worker does not inherit the SPM command set in the parent process
+    from nipype.interfaces import spm
+    spm.SPMCommand.set_mlab_paths(matlab_cmd=template_dict['matlab_cmd'], use_mcr=True)
+
+    # Directory in which fmri outputs will be written
+    fmri_out = subject_output_dir(subject_plan, write_dir, data_type)
+
+    # nipype working directory of this subject, moved to scratch_dir when the subject fits in the scratch budget
+    work_dir = os.path.join(os.getcwd(), 'fmri_preprocess', label)
+    reservation = None
+
+    result = {
+        'index': subject_plan.index,
+        'sub_id': sub_id,
+        'session': session,
+        'label': label,
+        'fmri_out': fmri_out,
+        'FD_rms_mean': None,
+        'FD_max': None,
+        'FD_spikes': None,
+        'num_volumes': None,
+        'quantisation': [],
+        'compression': [],
+        'stage_times': dict(),
+        'scratch': False,
+        'error': None
+    }
+
+    try:
+        # Create output dir for sub_id
+        os.makedirs(fmri_out, exist_ok=True)
+
+        if data_type == 'dicoms':
+            # The conversion stage of fmri_conversion has usually converted the dicoms already
+            if subject_plan.conversion_error is not None:
+                raise RuntimeError(subject_plan.conversion_error)
+            input_file = subject_plan.converted_file
+            with stdchannel_redirected(sys.stderr, os.devnull):
+                if input_file is None:
+                    input_file = convert_dicoms(subject_plan, fmri_out, **template_dict)
+        else:
+            # Assign input nifiti file for reorienation node
+            input_file = subject_plan.path
+        nii_output = (input_file.split('/')[-1]).split('.gz')[0]
+        # Header-only load, the zooms and shape are read from the header
+        with stdchannel_redirected(sys.stderr, os.devnull):
+            n1_img = nib.load(input_file)
+        reservation = fmri_scratch.ScratchReservation(template_dict['scratch_dir'], template_dict['scratch_budget_mb'],
+                                                      fmri_scratch.estimated_scratch_bytes(n1_img))
+        work_dir = reservation.work_dir(os.getcwd(), label)
+        result['scratch'] = reservation.on_scratch
+
+        """
+        Stage the nifti file from input data uncompressed into output directory, for dicoms this stages the converted
+        nifti file next to the output of dcm_nii_convert
+        """
+        stage_start = time.time()
+        fmri_staging.stage_input(input_file, os.path.join(fmri_out, nii_output))
+        result['stage_times']['staging'] = time.time() - stage_start
+
+        # Create fmri_spm12 dir under the specific sub-id/func
+        os.makedirs(
+            os.path.join(fmri_out, template_dict['fmri_output_dirname']),
+            exist_ok=True)
+
+        nifti_file = glob.glob(os.path.join(fmri_out, '*.nii'))[0]
+
+        # run reorientation node and pass to realign
+        try:
+            with stdchannel_redirected(sys.stderr, os.devnull):
+                convert_and_run_reorient_script(nifti_file, work_dir)
+        except:
+            pass
+
+        # Create pipeline nodes from fmri_entities_layer.py for this subject
+        [realign, slicetiming, datasink, fmri_preprocess] = create_pipeline_nodes(
+            **template_dict)
+        fmri_preprocess.base_dir = work_dir
+
+        # Edit realign node inputs
+        realign.node.inputs.in_files = nifti_file
+
+        if template_dict['options_slicetime_ref_slice'] is not None: slicetiming.node.inputs.ref_slice = template_dict[
+            'options_slicetime_ref_slice']
+
+        # Edit Slicetiming node inputs
+        TR = n1_img.header.get_zooms()[-1]
+        if template_dict['options_repetition_time'] is not None: TR = template_dict['options_repetition_time']
+        num_slices = n1_img.shape[2]
+        slicetiming.node.inputs.in_files = nifti_file
+
+        slicetiming.node.inputs.num_slices = num_slices
+        if template_dict['options_num_slices'] is not None: slicetiming.node.inputs.num_slices = template_dict[
+            'options_num_slices']
+        slicetiming.node.inputs.time_repetition = TR
+        time_for_one_slice = TR / num_slices
+        slicetiming.node.inputs.time_acquisition = TR - time_for_one_slice
+        odd = range(1, num_slices + 1, 2)
+        even = range(2, num_slices + 1, 2)
+        acq_order = list(odd) + list(even)
+
+        if template_dict['options_acquisition_order'] is not None: acq_order = template_dict[
+            'options_acquisition_order']
+        slicetiming.node.inputs.slice_order = acq_order
+
+        # Edit datasink node inputs
+        datasink.node.inputs.base_directory = fmri_out
+
+        # Run the nipype pipeline
+        with stdchannel_redirected(sys.stderr, os.devnull):
+            fmri_preprocess.run(plugin='Linear', plugin_args={
+                'status_callback': stage_callback(result['stage_times'], **template_dict)})
+
+        # Motion quality control: Calculate Framewise Displacement
+        FD_rms = calculate_FD(glob.glob(os.path.join(fmri_out,
+                     template_dict['fmri_output_dirname'],'rp*.txt'))[0],**template_dict)
+        result['FD_rms_mean'] = float(np.mean(FD_rms))
+        result['FD_max'] = float(np.max(FD_rms))
+        result['FD_spikes'] = int(np.count_nonzero(FD_rms > template_dict['FD_spike_threshold']))
+        result['num_volumes'] = len(FD_rms) + 1
+
+        with stdchannel_redirected(sys.stderr, os.devnull):
+            nii_to_image_converter(
+                os.path.join(fmri_out,
+                             output_dirnames(**template_dict)[0]), label,
+                **template_dict)
+
+        # Quantise the outputs of the int16 stages of output_data_types
+        stage_start = time.time()
+        result['quantisation'] = fmri_datatype.apply_output_data_types(
+            [os.path.join(fmri_out, output_dirname) for output_dirname in
+             set([template_dict['fmri_output_dirname']] + output_dirnames(**template_dict))], **template_dict)
+        if result['quantisation']:
+            result['stage_times']['quantisation'] = time.time() - stage_start
+
+        # Compress the nifti outputs of the subject to .nii.gz
+        if template_dict['output_compression']:
+            stage_start = time.time()
+            result['compression'] = fmri_compression.compress_outputs(fmri_out, **template_dict)
+            result['stage_times']['compression'] = time.time() - stage_start
+
+    except Exception as e:
+        # If the above code fails for any reason update the error log for the subject id
+        # ex: the nifti file is not a nifti file
+        # the input file is not a brian scan
+        result['error'] = str(e) + str(traceback.format_exc())
+
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        if reservation is not None:
+            reservation.release()
+
+    # Row of the subject in the cohort QC table
+    fmri_qc_table.append_row(write_dir, result, time.time() - start_time, **template_dict)
+    return result
+
+
+def stage_callback(stage_times=None, **template_dict):
+    """Returns the nipype status callback called before and after each node of the workflow, it holds a host-wide
+    SPM slot from fmri_host_slots while an SPM node runs if host_slot_dir is set and adds the wall time of each node to
+    stage_times"""
+    from nipype.interfaces.spm.base import SPMCommand
+    host_slots = None
+    if template_dict['host_slot_dir']:
+        host_slots = fmri_host_slots.HostSlots(template_dict['host_slot_dir'], template_dict['host_slot_limit'],
+                                               template_dict['host_slot_priority'])
+
+    start_times = dict()
+
+    def status_callback(node, status):
+        if status == 'start':
+            # The scheduler may have widened the worker's cores since the last stage
+            num_threads = fmri_thread_budget.refresh_thread_limit()
+            if num_threads and isinstance(node.interface, SPMCommand):
+                fmri_entities_layer.limit_spm_threads(node, spm_num_threads=num_threads)
+        if host_slots is not None and isinstance(node.interface, SPMCommand):
+            if status == 'start':
+                host_slots.acquire()
+            else:
+                host_slots.release()
+        if stage_times is not None:
+            if status == 'start':
+                start_times[node.name] = time.time()
+            elif node.name in start_times:
+                stage_times[node.name] = stage_times.get(node.name, 0.0) + time.time() - start_times.pop(node.name)
+
+    return status_callback
+
+
+def framewise_displacement(realignment_parameters):
+    """Returns the framewise displacement of every volume after the first, from the realignment parameters array"""
+    realignment_parameters = np.array(realignment_parameters, dtype=float)
+    rot_indices = range(3, 6)
+    rad = 50
+    # assume head radius of 50mm
+    rot = realignment_parameters[:, rot_indices]
+    rdist = rad * np.tan(rot)
+    realignment_parameters[:, rot_indices] = rdist
+    diff = np.diff(realignment_parameters, axis=0)
+    return np.sqrt(np.sum(diff**2, axis=1))
+
+
+def calculate_FD(rp_text_file, **template_dict):
+    """Calculates Framewise displacement from realignment parameters. realignment parameters is calculated from realignment of raw nifti
+            Args:
+                realignment parameters.txt file
+            Returns:
+                FD_rms (array): Framewise displacement of every volume after the first
+            Comments:
+                Framewise Displacement of a time series is defined as the sum of the absolute values of the derivatives of the six realignment parameters.
+                realignmental displacements are converted from degrees to millimeters by calculating displacement on the surface of a sphere of radius 50 mm.
+                Subjects over FD_rms_mean_threshold are flagged in the cohort QC table (fmri_qc_table)
+            """
+    FD_rms = framewise_displacement(np.loadtxt(rp_text_file))
+    FD_rms_mean = np.mean(FD_rms)
+    write_path = os.path.dirname(rp_text_file)
+
+    with open(
+            os.path.join(write_path, template_dict['fmri_qc_filename']),
+            'w') as fp:
+        fp.write("%3.2f\n" % (FD_rms_mean))
+        fp.close()
+    return FD_rms
+
+def nii_to_image_converter(write_dir, label, **template_dict):
+    """This function converts nifti to the display png, from the middle volume of the series (fmri_display)"""
+    file = glob.glob(os.path.join(write_dir, template_dict['display_nifti']))
+    fmri_display.render_display_image(file[0], os.path.join(write_dir, template_dict['display_image_name']), label,
+                                      **template_dict)
+
+
+def resampled_in_normalize(**template_dict):
+    """Returns True if Normalize12 writes directly on the regression resample grid"""
+    return bool(template_dict.get('regression_resample_in_normalize')) and template_dict[
+        'regression_resample_voxel_size'] is not None and not template_dict.get('sweep_variants') and not template_dict[
+        'standalone']
+
+
+def output_dirnames(**template_dict):
+    """Returns the names of the directories under each subject's func directory that hold the normalized and smoothed
+    images, one per parameter sweep variant or just fmri_output_dirname when nothing is swept. The first one is used
+    for the display image and the regression input files
+    """
+    if template_dict.get('sweep_variants'):
+        return [template_dict['fmri_output_dirname'] + '_' + variant['suffix'] for variant in
+                template_dict['sweep_variants']]
+    return [template_dict['fmri_output_dirname']]
+
+
+def create_pipeline_nodes(**template_dict):
+    """This function creates and modifies nodes of the pipeline from entities layer with nipype
+           smooth.node.inputs.fwhm: (a list of from 3 to 3 items which are a float or a float)
+           3-list of fwhm for each dimension
+           This is the size of the Gaussian (in mm) for smoothing the preprocessed data by. This is typically between about 4mm and 12mm.
+           For a parameter sweep the workflow branches after normalize estimation, each swept voxel size gets one
+           normalize write node and each variant its own smoothing node
+       """
+
+    # 1 Realign node and settings #
+    realign = fmri_entities_layer.Realign(**template_dict)
+
+    # 2 Slicetiming Node and settings #
+    slicetiming = fmri_entities_layer.Slicetiming(**template_dict)
+
+    # 5 Datsink Node that collects swa files and writes to temp_write_dir #
+    datasink = fmri_entities_layer.Datasink()
+
+    ## 6 Create the pipeline/workflow and connect the nodes created above ##
+    fmri_preprocess = pe.Workflow(name="fmri_preprocess")
+
+    workflow_inputs = [
+        create_workflow_input(
+            source=realign.node,
+            target=datasink.node,
+            source_output='mean_image',
+            target_input=template_dict['fmri_output_dirname']),
+        create_workflow_input(
+            source=realign.node,
+            target=datasink.node,
+            source_output='realigned_files',
+            target_input=template_dict['fmri_output_dirname'] + '.@1'),
+        create_workflow_input(
+            source=realign.node,
+            target=datasink.node,
+            source_output='realignment_parameters',
+            target_input=template_dict['fmri_output_dirname'] + '.@2'),
+        create_workflow_input(
+            source=slicetiming.node,
+            target=datasink.node,
+            source_output='timecorrected_files',
+            target_input=template_dict['fmri_output_dirname'] + '.@3')
+    ]
+
+    if template_dict.get('sweep_variants'):
+        # 3 Normalize estimation runs once for all the variants #
+        normalize = fmri_entities_layer.NormalizeEstimate(**template_dict)
+        workflow_inputs.append(
+            create_workflow_input(
+                source=realign.node,
+                target=normalize.node,
+                source_output='mean_image',
+                target_input='image_to_align'))
+
+        # 3b Normalize write runs once per voxel size, the kernels of a voxel size smooth the same normalized images #
+        normalize_writes = dict()
+        for variant, output_dirname in zip(template_dict['sweep_variants'], output_dirnames(**template_dict)):
+            variant_dict = dict(template_dict, **variant)
+
+            voxel_sizes = tuple(variant['options_normalize_write_voxel_sizes'])
+            if voxel_sizes not in normalize_writes:
+                normalize_writes[voxel_sizes] = fmri_entities_layer.NormalizeWrite(
+                    name='normalize_write_vox' + variant['suffix'].split('_vox')[-1], **variant_dict)
+                workflow_inputs.extend([
+                    create_workflow_input(
+                        source=normalize.node,
+                        target=normalize_writes[voxel_sizes].node,
+                        source_output='deformation_field',
+                        target_input='deformation_file'),
+                    create_workflow_input(
+                        source=slicetiming.node,
+                        target=normalize_writes[voxel_sizes].node,
+                        source_output='timecorrected_files',
+                        target_input='apply_to_files')
+                ])
+            normalize_write = normalize_writes[voxel_sizes]
+
+            # 4 Smoothing Node of the variant #
+            smooth = fmri_entities_layer.Smooth(name='smoothing_' + variant['suffix'], **variant_dict)
+
+            workflow_inputs.extend([
+                create_workflow_input(
+                    source=normalize_write.node,
+                    target=smooth.node,
+                    source_output='normalized_files',
+                    target_input='in_files'),
+                create_workflow_input(
+                    source=normalize_write.node,
+                    target=datasink.node,
+                    source_output='normalized_files',
+                    target_input=output_dirname + '.@4'),
+                create_workflow_input(
+                    source=smooth.node,
+                    target=datasink.node,
+                    source_output='smoothed_files',
+                    target_input=output_dirname + '.@5')
+            ])
+    else:
+        # 3 Normalize Node and settings #
+        normalize = fmri_entities_layer.Normalize(**template_dict)
+        if resampled_in_normalize(**template_dict):
+            # Write normalized images on the regression grid, smoothing then runs at that resolution
+            normalize.node.inputs.write_voxel_sizes = list(template_dict['regression_resample_voxel_size'])
+
+        # 4 Smoothing Node & Settings #
+        smooth = fmri_entities_layer.Smooth(**template_dict)
+
+        workflow_inputs.extend([
+            create_workflow_input(
+                source=realign.node,
+                target=normalize.node,
+                source_output='mean_image',
+                target_input='image_to_align'),
+            create_workflow_input(
+                source=slicetiming.node,
+                target=normalize.node,
+                source_output='timecorrected_files',
+                target_input='apply_to_files'),
+            create_workflow_input(
+                source=normalize.node,
+                target=smooth.node,
+                source_output='normalized_files',
+                target_input='in_files'),
+            create_workflow_input(
+                source=normalize.node,
+                target=datasink.node,
+                source_output='normalized_files',
+                target_input=template_dict['fmri_output_dirname'] + '.@4'),
+            create_workflow_input(
+                source=smooth.node,
+                target=datasink.node,
+                source_output='smoothed_files',
+                target_input=template_dict['fmri_output_dirname'] + '.@5')
+        ])
+
+    fmri_preprocess.connect(workflow_inputs)
+    return [realign, slicetiming, datasink, fmri_preprocess]
+
+def create_workflow_input(source, target, source_output, target_input):
+    """This function collects pipeline nodes and their connections
+    and returns them in appropriate format for nipype pipeline workflow
+    """
+    return (source, target, [(source_output, target_input)])
+
+def convert_and_run_reorient_script(input_file, work_dir):
+    """Writes the reorient batch of input_file and its job script into work_dir, the working directory of the subject,
+    and points the SPM command of this process at that job. Concurrent subjects each have their own job files"""
+    from nipype.interfaces import spm
+    os.makedirs(work_dir, exist_ok=True)
+    reorient_file = os.path.join(work_dir, 'reorient.m')
+    reorient_job_file = os.path.join(work_dir, 'reorient_job.m')
+    with open('/computation/reorient_template.m') as fp:
+        text = fp.read()
+    with open(reorient_file, 'w') as fp:
+        fp.write(text.replace('input_file', input_file))
+    with open('/computation/reorient_job.m') as fp:
+        text = fp.read()
+    with open(reorient_job_file, 'w') as fp:
+        fp.write(text.replace('/computation/reorient.m', reorient_file))
+    # Run convert_to_mat_file.m script using spm12 standalone and Matlab MCR
+    with stdchannel_redirected(sys.stderr, os.devnull):
+        spm.SPMCommand.set_mlab_paths(matlab_cmd='/opt/spm12/run_spm12.sh /opt/mcr/v95 script ' + reorient_job_file,
+                                  use_mcr=True)
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This layer splits the cpus of the container between the subjects running at once, so that concurrent MCR processes and
+numpy stages do not each use every core
+Each worker is assigned a number of cores, passed to SPM as maxNumCompThreads in the generated batch and to native stages
+through the BLAS/OpenMP environment limits. Cores freed by finished workers go to the workers started next, and once no
+subject is left to start they widen the running workers. A worker's cores are kept in shared memory that the scheduler
+rewrites, the worker applies its widened share from the start of its next stage
+On NUMA hosts the workers can be pinned to core sets taken from a single node
+"""
+import os, glob
+
+# if available limit the BLAS threads of numpy already loaded in this process
+try:
+    import threadpoolctl
+except ImportError:
+    threadpoolctl = None
+
+THREAD_ENVIRONMENT_VARIABLES = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                                'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+
+def parse_cpulist(cpulist):
+    """Returns the cpu ids of a kernel cpulist string, e.g. 0-3,8-11"""
+    cpu_ids = list()
+    for cpu_range in cpulist.strip().split(','):
+        if not cpu_range:
+            continue
+        if '-' in cpu_range:
+            first, last = cpu_range.split('-')
+            cpu_ids.extend(range(int(first), int(last) + 1))
+        else:
+            cpu_ids.append(int(cpu_range))
+    return cpu_ids
+
+
+def read_numa_nodes(cpu_ids):
+    """Returns the usable cpu ids grouped by NUMA node, a single group when the host has no NUMA information"""
+    nodes = list()
+    for cpulist_file in sorted(glob.glob('/sys/devices/system/node/node*/cpulist')):
+        try:
+            with open(cpulist_file) as fp:
+                node_cpu_ids = [cpu_id for cpu_id in parse_cpulist(fp.read()) if cpu_id in cpu_ids]
+        except (IOError, OSError, ValueError):
+            continue
+        if node_cpu_ids:
+            nodes.append(node_cpu_ids)
+    return nodes or [list(cpu_ids)]
+
+
+class ThreadBudget:
+    """Assigns the cores of the container to workers
+        Args:
+            cpus (int): number of cores the container may use, from its cgroup cpu limit
+            pin (bool): pin each worker to a core set taken from a single NUMA node when possible
+    """
+
+    def __init__(self, cpus, pin=False):
+        if hasattr(os, 'sched_getaffinity'):
+            cpu_ids = sorted(os.sched_getaffinity(0))
+        else:
+            cpu_ids = list(range(os.cpu_count() or 1))
+        self.cpu_ids = cpu_ids[:max(1, cpus)]
+        self.pin = pin
+        self.nodes = read_numa_nodes(self.cpu_ids) if pin else [self.cpu_ids]
+        self.assigned = dict()
+
+    def free_cpu_ids(self):
+        used = set([cpu_id for cpu_ids in self.assigned.values() for cpu_id in cpu_ids])
+        return [[cpu_id for cpu_id in node if cpu_id not in used] for node in self.nodes]
+
+    def acquire(self, key, open_slots):
+        """Assigns cores to the worker key, the free cores are shared evenly between the open_slots workers still to
+        be started (including this one), every worker gets at least one core
+        Returns:
+            cpu_ids (list): the cores of the worker, only binding when the budget pins workers
+        """
+        free_nodes = self.free_cpu_ids()
+        num_free = sum([len(node) for node in free_nodes])
+        share = max(1, num_free // max(1, open_slots))
+        if num_free == 0:
+            # Oversubscribed, the worker shares a core picked round-robin
+            cpu_ids = [self.nodes[0][len(self.assigned) % len(self.nodes[0])]]
+        else:
+            # Take the cores from the node with the most free cores first
+            cpu_ids = list()
+            for node in sorted(free_nodes, key=len, reverse=True):
+                cpu_ids.extend(node[:share - len(cpu_ids)])
+                if len(cpu_ids) >= share:
+                    break
+        self.assigned[key] = cpu_ids
+        return cpu_ids
+
+    def release(self, key):
+        """Returns the cores of a finished worker to the budget"""
+        self.assigned.pop(key, None)
+
+    def rebalance(self):
+        """Hands the free cores to the running workers one at a time, the worker with the fewest cores first, pinned
+        workers only get cores of their own node. Used once no worker is left to start
+        Returns:
+            widened (dict): the cores of each worker whose share grew
+        """
+        widened = dict()
+        free_nodes = self.free_cpu_ids()
+        while True:
+            candidates = list()
+            for key, cpu_ids in self.assigned.items():
+                if self.pin:
+                    nodes = [free_node for free_node, node in zip(free_nodes, self.nodes) if cpu_ids[0] in node]
+                else:
+                    nodes = free_nodes
+                nodes = [free_node for free_node in nodes if free_node]
+                if nodes:
+                    candidates.append((len(cpu_ids), key, nodes[0]))
+            if not candidates:
+                return widened
+            num_cpu_ids, key, free_node = min(candidates, key=lambda candidate: candidate[0])
+            self.assigned[key] = self.assigned[key] + [free_node.pop(0)]
+            widened[key] = self.assigned[key]
+
+
+def shared_cpu_ids(context, cpu_ids, size):
+    """Returns the shared memory array holding the cores of a worker, padded with -1 to size cores"""
+    return context.Array('i', list(cpu_ids) + [-1] * (size - len(cpu_ids)))
+
+
+def write_cpu_ids(shared, cpu_ids):
+    with shared.get_lock():
+        shared[:] = list(cpu_ids) + [-1] * (len(shared) - len(cpu_ids))
+
+
+def read_cpu_ids(shared):
+    with shared.get_lock():
+        return [cpu_id for cpu_id in shared[:] if cpu_id >= 0]
+
+
+def apply_thread_limit(cpu_ids, pin=False):
+    """Limits the threads of the calling worker process and of the processes it starts to len(cpu_ids), pins them to
+    cpu_ids if requested"""
+    num_threads = str(len(cpu_ids))
+    for variable in THREAD_ENVIRONMENT_VARIABLES:
+        os.environ[variable] = num_threads
+    if threadpoolctl is not None:
+        threadpoolctl.threadpool_limits(len(cpu_ids))
+    if pin and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpu_ids)
+
+
+# Shared cores of the worker running in this process and the cores last applied, set by start_worker
+worker_share = {'shared': None, 'pin': False, 'applied': list()}
+
+
+def start_worker(shared, pin=False):
+    """Limits the calling worker process to the cores in the shared array, returns the number of cores"""
+    worker_share.update({'shared': shared, 'pin': pin, 'applied': list()})
+    return refresh_thread_limit()
+
+
+def refresh_thread_limit():
+    """Applies the cores of the worker again when the scheduler widened them, called before each stage
+        Returns:
+            num_threads (int): the number of cores of the worker, 0 outside a worker
+    """
+    if worker_share['shared'] is None:
+        return 0
+    cpu_ids = read_cpu_ids(worker_share['shared'])
+    if cpu_ids != worker_share['applied']:
+        apply_thread_limit(cpu_ids, worker_share['pin'])
+        worker_share['applied'] = cpu_ids
+    return len(cpu_ids)
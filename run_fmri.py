@@ -38,20 +38,46 @@ def stdchannel_redirected(stdchannel, dest_filename):
             dest_file.close()
 
 
-import ujson as json,getopt, re,traceback
-import warnings, os, glob, sys
-import nibabel as nib
-import numpy as np, scipy.io, spm_matrix as s
+import time
+startup_time = time.time()
+import ujson as json,getopt, re,traceback, importlib
+import warnings, os, sys
 
 with warnings.catch_warnings():
     warnings.filterwarnings("ignore")
-# Load Nipype spm interface #
-from nipype.interfaces import spm
-import fmri_use_cases_layer,fmri_standalone_use_cases_layer
+# nibabel, scipy, nipype and the use cases layers (bids, nilearn, matplotlib) are imported by the code paths using them,
+# so that a run returning a validation error does not load them
+import fmri_mcr_cache
 
-#Stop printing nipype.workflow info to stdout
-from nipype import logging
-logging.getLogger('nipype.workflow').setLevel('CRITICAL')
+# Seconds spent in each import and startup step, written to stderr when FMRI_STARTUP_PROFILE is set
+startup_profile = [('interpreter and base imports', time.time() - startup_time)]
+
+
+def import_module(name):
+    """Imports the module name on first use and records the time the import took in startup_profile"""
+    if name in sys.modules:
+        return sys.modules[name]
+    start_time = time.time()
+    module = importlib.import_module(name)
+    startup_profile.append(('import ' + name, time.time() - start_time))
+    return module
+
+
+@contextlib.contextmanager
+def startup_step(name):
+    """Records the time spent in a startup step in startup_profile"""
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        startup_profile.append((name, time.time() - start_time))
+
+
+def write_startup_profile():
+    """Writes the startup time breakdown to stderr, stdout is kept for the json output"""
+    if os.environ.get('FMRI_STARTUP_PROFILE', '') not in ('', '0'):
+        sys.stderr.write('Startup profile (seconds):\n' + ''.join(
+            ['{:>8.3f}  {}\n'.format(seconds, name) for name, seconds in startup_profile]))
 
 #Create a dictionary to store all paths to softwares,templates & store parameters, names of output files
 
@@ -81,6 +107,8 @@ template_dict = {
         None,
     'regression_resample_method':
         'Li',
+    'regression_resample_in_normalize': False,
+    'sweep_variants': list(),
     'FWHM_SMOOTH': [6, 6, 6],
     'options_reorient_params_x_mm': 0,
     'options_reorient_params_y_mm': 0,
@@ -119,6 +147,41 @@ template_dict = {
     60,
     'fmri_output_dirname':
         'fmri_spm12',
+    'cache_dir':
+        os.path.join(os.path.expanduser('~'), '.cache', 'coinstac_fmri'),
+    'planner_history_filename':
+        'fmri_subject_timings.json',
+    'planner_num_threads': 8,
+    'num_workers': 1,
+    'memory_reserve_mb': 1024,
+    'pin_workers': False,
+    'host_slot_dir': None,
+    'host_slot_limit': 4,
+    'host_slot_priority': 0,
+    'mcr_cache_dirname': 'mcr_cache',
+    'server_socket': '/tmp/fmri_server.sock',
+    'server_max_jobs': 1,
+    'conversion_num_threads': 2,
+    'conversion_max_in_flight': 4,
+    'conversion_cache_dirname': 'dicom_conversions',
+    'bids_index_num_threads': 8,
+    'gzip_index_dirname': 'gzip_index',
+    'display_renderer': 'nilearn',
+    'display_cache_dirname': 'display_images',
+    'display_cache_max_mb': 256,
+    'qc_report': True,
+    'qc_report_dirname': 'qc_report',
+    'qc_report_num_workers': 0,
+    'qc_report_carpet_voxels': 1500,
+    'archive_num_threads': 0,
+    'archive_compresslevel': 6,
+    'output_compression': False,
+    'compression_level': 6,
+    'compression_num_threads': 0,
+    'output_data_types': {'realign': 'same', 'slicetiming': 'same', 'normalize': 'same', 'smooth': 'same'},
+    'scratch_dir': None,
+    'scratch_budget_mb': 8192,
+    'conversion_cache_max_mb': 10240,
     'output_zip_dir':
         'fmri_outputs',
     'log_filename':
@@ -140,6 +203,10 @@ template_dict = {
     0.2, #in mm
     'fmri_qc_filename':
         'QC_Framewise_displacement.txt',
+    'qc_table_filename':
+        'QC_subjects',
+    'FD_spike_threshold':
+    0.5, #in mm
     'outputs_manual_name':
         'outputs_description.txt',
     'coinstac_display_info':
@@ -193,7 +260,47 @@ scan_type is the type of structural scans on which is accepted by this pipeline
 FWHM_SMOOTH is the full width half maximum smoothing kernel value in mm in x,y,z directions
 fmri_output_dirname is the name of the output directory to which the outputs from this pipeline are written to
 fmri_qc_filename is the name of the fmri quality control text file , which is placed in fmri_output_dirname
+qc_table_filename is the name of the cohort QC table in the output zip, a .csv file and a .bin file of fixed-size
+records (fmri_qc_table), with the FD mean, max and number of volumes over FD_spike_threshold of each subject
 FWHM_SMOOTH is an optional parameter that can be passed as json in args['input']['opts']
+cache_dir is where results that are reused across runs are kept, e.g. the subject timings in planner_history_filename used by
+fmri_planner to estimate runtimes and order the subjects longest-first
+num_workers is the number of subjects processed concurrently, 0 uses one worker per cpu of the container. fmri_scheduler
+only starts a subject when its estimated peak memory fits the container's memory limit minus memory_reserve_mb
+The cores of the container are split between running subjects by fmri_thread_budget (maxNumCompThreads for SPM,
+BLAS/OpenMP thread limits for native stages), pin_workers pins each subject to a core set of one NUMA node
+host_slot_dir is a directory shared by all the containers of a host, when set every SPM stage holds one of host_slot_limit
+host-wide slots (fmri_host_slots), slots go to higher host_slot_priority runs first and are shared fairly between runs
+mcr_cache_dirname in cache_dir holds the MCR cache seed warmed by software_check and one persistent MCR_CACHE_ROOT per worker
+and the SPM version found by software_check, reused until the SPM or MCR install changes or FMRI_FORCE_SPM_CHECK is set
+server_socket and server_max_jobs are the defaults of run_fmri.py --serve (fmri_server), a server forks one process per job and
+runs at most server_max_jobs jobs at once, the others are queued
+dicoms are converted ahead of the processing by conversion_num_threads threads (fmri_conversion), at most
+conversion_max_in_flight subjects are converted without having started
+conversion_cache_dirname in cache_dir keeps the converted series of earlier runs keyed on SeriesInstanceUID and their file
+sizes, the least recently used are evicted over conversion_cache_max_mb
+BIDS inputs are found by fmri_bids_index with bids_index_num_threads threads, its index of the directories and of the
+validation of the scans is kept in cache_dir
+gzip_index_dirname in cache_dir stores the seek-point indexes of .nii.gz files read one volume at a time (fmri_gzip_index)
+display_renderer 'png' writes the display image's orthogonal slices straight to png instead of rendering them with nilearn,
+renderings are cached in display_cache_dirname of cache_dir, the least recently used are evicted over display_cache_max_mb
+qc_report writes the cohort QC report qc_report.html in qc_report_dirname of the output zip, with a mosaic, FD and DVARS
+traces and a carpet plot of qc_report_carpet_voxels voxels per subject, rendered by qc_report_num_workers processes (0 for
+one per cpu)
+the output zip is written by fmri_archive as the subjects finish, with archive_num_threads compression threads (0 for one
+per cpu) at zlib level archive_compresslevel, already compressed files are stored
+output_compression compresses the nifti outputs and regression inputs to .nii.gz with fmri_compression, in
+compression_num_threads threads (0 for the cores of the subject's worker) at zlib level compression_level
+output_data_types is the datatype of the images of each stage in the outputs, 'same' keeps what SPM writes, 'int16'
+quantises the float images with a scale factor and reports the error, other SPM datatypes (fmri_datatype.SPM_DATA_TYPES)
+are written by SPM for the stages whose interface has a data type field (smooth)
+scratch_dir is a tmpfs or local SSD directory for the nipype working directories of the subjects, up to
+scratch_budget_mb at once across the host (fmri_scratch), subjects that do not fit run in the current directory. The
+wall time of each stage is in the output message
+sweep_variants is filled by args_parser when smoothing or voxel size options are given as lists, the upstream stages run once
+and each variant is written and smoothed into its own fmri_spm12_<suffix> directory
+regression_resample_in_normalize makes Normalize12 write directly on the regression_resample_voxel_size grid, so smoothing runs at
+that resolution and the regression input is linked instead of being resampled a second time
 json output description
                     "message"-This string is used by coinstac to display output message to the user on the UI after computation is finished
                     "download_outputs"-Zipped directory where outputs are stored
@@ -205,10 +312,22 @@ with warnings.catch_warnings():
 
 def software_check():
     """This function returns the spm standalone version installed inside the docker
+    The version is cached on disk for the installed SPM and MCR, set FMRI_FORCE_SPM_CHECK=1 to start SPM and check it again
     """
-    spm.SPMCommand.set_mlab_paths(
+    def probe():
+        set_spm_paths()
+        return import_module('nipype.interfaces.spm').SPMCommand().version
+
+    # The first start of the container warms the MCR cache seeded into the cache root of each worker
+    return fmri_mcr_cache.cached_spm_version(probe,
+                                             force=os.environ.get('FMRI_FORCE_SPM_CHECK', '') not in ('', '0'),
+                                             **template_dict)
+
+
+def set_spm_paths():
+    """Sets the MCR command used by the nipype spm interfaces"""
+    import_module('nipype.interfaces.spm').SPMCommand.set_mlab_paths(
         matlab_cmd=template_dict['matlab_cmd'], use_mcr=True)
-    return (spm.SPMCommand().version)
 
 
 def args_parser(args):
@@ -224,11 +343,60 @@ def args_parser(args):
 
     if 'regression_resample_voxel_size' in args['input']:
         template_dict['regression_resample_voxel_size']=tuple([float(args['input']['regression_resample_voxel_size'])]*3)
+    if 'cache_dir' in args['input']:
+        template_dict['cache_dir']=args['input']['cache_dir']
+    if 'num_workers' in args['input']:
+        template_dict['num_workers']=int(args['input']['num_workers'])
+    if 'memory_reserve_mb' in args['input']:
+        template_dict['memory_reserve_mb']=int(args['input']['memory_reserve_mb'])
+    if 'pin_workers' in args['input']:
+        template_dict['pin_workers']=parse_bool(args['input']['pin_workers'])
+    if 'display_renderer' in args['input']:
+        template_dict['display_renderer']=args['input']['display_renderer']
+    if 'display_cache_max_mb' in args['input']:
+        template_dict['display_cache_max_mb']=int(args['input']['display_cache_max_mb'])
+    if 'qc_report' in args['input']:
+        template_dict['qc_report']=parse_bool(args['input']['qc_report'])
+    if 'qc_report_num_workers' in args['input']:
+        template_dict['qc_report_num_workers']=int(args['input']['qc_report_num_workers'])
+    if 'qc_report_carpet_voxels' in args['input']:
+        template_dict['qc_report_carpet_voxels']=int(args['input']['qc_report_carpet_voxels'])
+    if 'archive_num_threads' in args['input']:
+        template_dict['archive_num_threads']=int(args['input']['archive_num_threads'])
+    if 'archive_compresslevel' in args['input']:
+        template_dict['archive_compresslevel']=int(args['input']['archive_compresslevel'])
+    if 'output_compression' in args['input']:
+        template_dict['output_compression']=parse_bool(args['input']['output_compression'])
+    if 'compression_level' in args['input']:
+        template_dict['compression_level']=int(args['input']['compression_level'])
+    if 'compression_num_threads' in args['input']:
+        template_dict['compression_num_threads']=int(args['input']['compression_num_threads'])
+    if 'output_data_types' in args['input']:
+        template_dict['output_data_types'].update(args['input']['output_data_types'])
+    if 'scratch_dir' in args['input']:
+        template_dict['scratch_dir']=args['input']['scratch_dir']
+    if 'scratch_budget_mb' in args['input']:
+        template_dict['scratch_budget_mb']=int(args['input']['scratch_budget_mb'])
+    if 'conversion_num_threads' in args['input']:
+        template_dict['conversion_num_threads']=int(args['input']['conversion_num_threads'])
+    if 'conversion_max_in_flight' in args['input']:
+        template_dict['conversion_max_in_flight']=int(args['input']['conversion_max_in_flight'])
+    if 'conversion_cache_max_mb' in args['input']:
+        template_dict['conversion_cache_max_mb']=int(args['input']['conversion_cache_max_mb'])
+    if 'host_slot_dir' in args['input']:
+        template_dict['host_slot_dir']=args['input']['host_slot_dir']
+    if 'host_slot_limit' in args['input']:
+        template_dict['host_slot_limit']=int(args['input']['host_slot_limit'])
+    if 'host_slot_priority' in args['input']:
+        template_dict['host_slot_priority']=int(args['input']['host_slot_priority'])
+
+    if 'regression_resample_in_normalize' in args['input']:
+        template_dict['regression_resample_in_normalize']=parse_bool(args['input']['regression_resample_in_normalize'])
 
     if 'registration_template' in args['input']:
         if os.path.isfile(args['input']['registration_template']) and (str(
-                ((nib.load(template_dict['tpm_path'])).shape)) == str(
-            ((nib.load(args['input']['registration_template'])).shape))):
+                ((import_module('nibabel').load(template_dict['tpm_path'])).shape)) == str(
+            ((import_module('nibabel').load(args['input']['registration_template'])).shape))):
             template_dict['tpm_path'] = args['input']['registration_template']
         else:
             sys.stdout.write(
@@ -303,24 +471,35 @@ def args_parser(args):
         template_dict['options_normalize_write_bounding_box']=args['input']['options_normalize_write_bounding_box']
     if 'options_normalize_write_interp' in args['input']:
         template_dict['options_normalize_write_interp']=int(args['input']['options_normalize_write_interp'])
+    sweep_voxel_sizes = [template_dict['options_normalize_write_voxel_sizes']]
     if 'options_normalize_write_voxel_sizes' in args['input']:
-        template_dict['options_normalize_write_voxel_sizes']=args['input']['options_normalize_write_voxel_sizes']
+        # A list of voxel size lists is swept
+        if isinstance(args['input']['options_normalize_write_voxel_sizes'][0], list):
+            sweep_voxel_sizes = args['input']['options_normalize_write_voxel_sizes']
+        else:
+            sweep_voxel_sizes = [args['input']['options_normalize_write_voxel_sizes']]
+        template_dict['options_normalize_write_voxel_sizes']=sweep_voxel_sizes[0]
 
 
-    if 'options_smoothing_x_mm' in args['input']:
-         template_dict['FWHM_SMOOTH'][0]= float(args['input']['options_smoothing_x_mm'])
-    if 'options_smoothing_y_mm' in args['input']:
-         template_dict['FWHM_SMOOTH'][1]= float(args['input']['options_smoothing_y_mm'])
-    if 'options_smoothing_z_mm' in args['input']:
-        template_dict['FWHM_SMOOTH'][2] = float(args['input']['options_smoothing_z_mm'])
+    # A list of smoothing kernel values is swept, lists given for several axes are paired in order
+    sweep_fwhm = [[value] for value in template_dict['FWHM_SMOOTH']]
+    for axis, option in enumerate(['options_smoothing_x_mm', 'options_smoothing_y_mm', 'options_smoothing_z_mm']):
+        if option in args['input']:
+            if isinstance(args['input'][option], list):
+                sweep_fwhm[axis] = [float(value) for value in args['input'][option]]
+            else:
+                sweep_fwhm[axis] = [float(args['input'][option])]
+            template_dict['FWHM_SMOOTH'][axis] = sweep_fwhm[axis][0]
+
+    template_dict['sweep_variants'] = sweep_variants(sweep_fwhm, sweep_voxel_sizes)
 
     if 'options_smoothing_implicit_masking' in args['input']:
         template_dict['options_implicit_masking']=args['input']['options_smoothing_implicit_masking']
 
     if 'options_registration_template' in args['input']:
         if os.path.isfile(args['input']['options_registration_template']) and (str(
-            ((nib.load(template_dict['tpm_path'])).shape)) == str(
-                ((nib.load(args['input']['options_registration_template'])).shape))):
+            ((import_module('nibabel').load(template_dict['tpm_path'])).shape)) == str(
+                ((import_module('nibabel').load(args['input']['options_registration_template'])).shape))):
             template_dict['tpm_path'] = args['input']['options_registration_template']
         else:
             sys.stdout.write(
@@ -333,8 +512,52 @@ def args_parser(args):
                 }))
             sys.exit()
 
+
+def parse_bool(value):
+    """Returns the boolean of an option given as a bool, 0/1 or one of the strings true/false/0/1, raises ValueError
+    for any other value. bool() would read the string 'false' as True"""
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, int) and value in (0, 1):
+        return bool(value)
+    if isinstance(value, str) and value.strip().lower() in ('true', 'false', '0', '1'):
+        return value.strip().lower() in ('true', '1')
+    raise ValueError('Not a boolean option value: ' + repr(value))
+
+
+def sweep_variants(sweep_fwhm, sweep_voxel_sizes):
+    """Returns the parameter sweep variants, one dict per combination of smoothing kernel and voxel sizes
+    Args:
+        sweep_fwhm (list): list of fwhm values for each of the x,y,z directions
+        sweep_voxel_sizes (list): list of normalize write voxel sizes
+    Returns:
+        variants (list): empty when nothing is swept, otherwise dicts with the template_dict values of each variant
+                         and the suffix of its fmri_spm12_* output directory
+    """
+    num_kernels = max([len(values) for values in sweep_fwhm])
+    if [values for values in sweep_fwhm if len(values) not in (1, num_kernels)]:
+        raise ValueError('Swept smoothing options must have the same number of values')
+    kernels = [[values[i] if len(values) > 1 else values[0] for values in sweep_fwhm] for i in range(num_kernels)]
+    if len(kernels) == 1 and len(sweep_voxel_sizes) == 1:
+        return list()
+
+    def suffix(values):
+        return '_'.join(['{:g}'.format(float(value)).replace('.', 'p') for value in values])
+
+    variants = list()
+    for voxel_sizes in sweep_voxel_sizes:
+        for kernel in kernels:
+            variants.append({
+                'suffix': 'fwhm' + suffix(kernel) + '_vox' + suffix(voxel_sizes),
+                'FWHM_SMOOTH': kernel,
+                'options_normalize_write_voxel_sizes': voxel_sizes
+            })
+    return variants
+
+
 def convert_reorientparams_save_to_mat_script():
     try:
+        import numpy as np, scipy.io, spm_matrix as s
         pi = 22 / 7
         scipy.io.savemat('/computation/transform.mat',
                          mdict={'M': np.around(s.spm_matrix([template_dict['options_reorient_params_x_mm'],
@@ -366,6 +589,12 @@ def data_parser(args):
 
     WriteDir = args['state']['outputDirectory']
 
+    set_spm_paths()
+    #Stop printing nipype.workflow info to stdout
+    import_module('nipype').logging.getLogger('nipype.workflow').setLevel('CRITICAL')
+    fmri_use_cases_layer = import_module('fmri_use_cases_layer')
+    fmri_standalone_use_cases_layer = import_module('fmri_standalone_use_cases_layer')
+
     if template_dict['standalone']:
         # Check if data has nifti files
         if [x
@@ -381,12 +610,21 @@ def data_parser(args):
         elif os.path.isfile(os.path.join(data[0],
                                        'dataset_description.json')) and os.access(
                                            WriteDir, os.W_OK):
-            cmd = "bids-validator {0}".format(data[0])
-            bids_process = os.popen(cmd).read()
             bids_dir = data[0]
-            if bids_process and ('func' in bids_process) and (len(layout.get(modality='func', extensions='.nii.gz')) > 0):
+            # Func scans found by the cached BIDS index, only the scans to be processed are validated
+            func_scans, bids_errors = import_module('fmri_bids_index').discover(bids_dir, **template_dict)
+            if not func_scans:
+                sys.stdout.write(
+                    json.dumps({
+                        "output": {
+                            "message": "No valid func scans found in " + str(bids_dir) + " Error log:" + str(bids_errors)
+                        },
+                        "cache": {},
+                        "success": True
+                    }))
+            else:
                 computation_output = fmri_standalone_use_cases_layer.setup_pipeline(
-                    data=bids_dir,
+                    data=func_scans,
                     write_dir=WriteDir,
                     data_type='bids',
                     **template_dict)
@@ -394,14 +632,9 @@ def data_parser(args):
         # Check if inputs are dicoms
         elif [x
               for x in data if os.path.isdir(x)] and os.access(WriteDir, os.W_OK):
-            dicom_dirs = list()
-            for dcm in data:
-                if os.path.isdir(dcm) and os.listdir(dcm):
-                    dicom_file = glob.glob(dcm + '/*')[0]
-                    with stdchannel_redirected(sys.stderr, os.devnull):
-                        dicom_header_info = os.popen('strings' + ' ' + dicom_file +
-                                                     '|grep DICM').read()
-                    if 'DICM' in dicom_header_info: dicom_dirs.append(dcm)
+            # Directories holding dicom files, detected from their preamble and magic in parallel threads
+            dicom_dirs = import_module('fmri_dicom_index').find_dicom_dirs(
+                [dcm for dcm in data if os.path.isdir(dcm)], template_dict['planner_num_threads'])
             computation_output = fmri_standalone_use_cases_layer.setup_pipeline(
                 data=dicom_dirs,
                 write_dir=WriteDir,
@@ -437,13 +670,21 @@ def data_parser(args):
         elif os.path.isfile(os.path.join(data[0],
                                          'dataset_description.json')) and os.access(
             WriteDir, os.W_OK):
-            cmd = "bids-validator {0}".format(data[0])
-            bids_process = os.popen(cmd).read()
             bids_dir = data[0]
-            if bids_process and ('func' in bids_process) and (
-                    len(layout.get(modality='func', extensions='.nii.gz')) > 0):
+            # Func scans found by the cached BIDS index, only the scans to be processed are validated
+            func_scans, bids_errors = import_module('fmri_bids_index').discover(bids_dir, **template_dict)
+            if not func_scans:
+                sys.stdout.write(
+                    json.dumps({
+                        "output": {
+                            "message": "No valid func scans found in " + str(bids_dir) + " Error log:" + str(bids_errors)
+                        },
+                        "cache": {},
+                        "success": True
+                    }))
+            else:
                 computation_output = fmri_use_cases_layer.setup_pipeline(
-                    data=bids_dir,
+                    data=func_scans,
                     write_dir=WriteDir,
                     data_type='bids',
                     **template_dict)
@@ -451,14 +692,9 @@ def data_parser(args):
         # Check if inputs are dicoms
         elif [x
               for x in data if os.path.isdir(x)] and os.access(WriteDir, os.W_OK):
-            dicom_dirs = list()
-            for dcm in data:
-                if os.path.isdir(dcm) and os.listdir(dcm):
-                    dicom_file = glob.glob(dcm + '/*')[0]
-                    with stdchannel_redirected(sys.stderr, os.devnull):
-                        dicom_header_info = os.popen('strings' + ' ' + dicom_file +
-                                                     '|grep DICM').read()
-                    if 'DICM' in dicom_header_info: dicom_dirs.append(dcm)
+            # Directories holding dicom files, detected from their preamble and magic in parallel threads
+            dicom_dirs = import_module('fmri_dicom_index').find_dicom_dirs(
+                [dcm for dcm in data if os.path.isdir(dcm)], template_dict['planner_num_threads'])
             computation_output = fmri_use_cases_layer.setup_pipeline(
                 data=dicom_dirs,
                 write_dir=WriteDir,
@@ -481,20 +717,22 @@ def data_parser(args):
                 }))
 
 
-if __name__ == '__main__':
-
+def run_job(input_json):
+    """Runs the computation on the input json, writes the output json to stdout"""
     try:
         # Check if spm is running
-        with stdchannel_redirected(sys.stderr, os.devnull):
+        with startup_step('spm version check'), stdchannel_redirected(sys.stderr, os.devnull):
             spm_check = software_check()
         if spm_check != template_dict['spm_version']:
             raise EnvironmentError("spm unable to start in fmri docker")
 
         #Read json args
-        args = json.loads(sys.stdin.read())
+        with startup_step('read input json'):
+            args = json.loads(input_json)
 
         #Parse args
-        args_parser(args)
+        with startup_step('parse args'):
+            args_parser(args)
 
         #Convert reorient params to mat file if they exist
         convert_reorientparams_save_to_mat_script()
@@ -502,4 +740,37 @@ if __name__ == '__main__':
         #Parse input data and run the code
         data_parser(args)
     except Exception as e:
-        sys.stderr.write('Unable to read input data or parse inputspec.json. Error_log:' + str(e) + str(traceback.format_exc()))
\ No newline at end of file
+        sys.stderr.write('Unable to read input data or parse inputspec.json. Error_log:' + str(e) + str(traceback.format_exc()))
+    finally:
+        write_startup_profile()
+
+
+def warm_up():
+    """Loads what every job needs once in the server process, the jobs are forked from it"""
+    with stdchannel_redirected(sys.stderr, os.devnull):
+        software_check()
+    set_spm_paths()
+    import_module('nipype').logging.getLogger('nipype.workflow').setLevel('CRITICAL')
+    for name in ['nibabel', 'scipy.io', 'nilearn.plotting', 'fmri_use_cases_layer', 'fmri_standalone_use_cases_layer',
+                 'fmri_subject_layer']:
+        import_module(name)
+
+
+if __name__ == '__main__':
+    # python3 run_fmri.py --serve [--socket path] [--jobs n] starts the server, run_fmri.py forwards its stdin to the
+    # server when FMRI_SERVER_SOCKET is set and runs the job itself when no server answers
+    opts = dict(getopt.getopt(sys.argv[1:], '', ['serve', 'socket=', 'jobs='])[0])
+    socket_path = opts.get('--socket', os.environ.get('FMRI_SERVER_SOCKET', template_dict['server_socket']))
+    fmri_server = import_module('fmri_server')
+    if '--serve' in opts:
+        warm_up()
+        fmri_server.serve(socket_path, run_job, int(opts.get('--jobs', template_dict['server_max_jobs'])))
+    else:
+        input_json = sys.stdin.read()
+        output = None
+        if os.environ.get('FMRI_SERVER_SOCKET'):
+            output = fmri_server.submit(socket_path, input_json)
+        if output is None:
+            run_job(input_json)
+        else:
+            sys.stdout.write(output)